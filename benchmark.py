@@ -0,0 +1,527 @@
+"""离线基准测试：在本机回环地址上模拟 Cloudflare 边缘节点、DNS API 和DNS解析器，测量 cfip.py 各阶段的性能
+
+Linux 上整个 127.0.0.0/8 都路由到本机回环接口，模拟节点监听 0.0.0.0，按连接的本地地址
+（getsockname）区分不同的"边缘IP"，每个IP有固定的延迟、状态码和带宽，另外按比例随机丢弃请求。
+模拟DNS解析器按查询携带的ECS子网返回不同地址，用于检查 domain_ip.py 的多地区解析。
+模拟服务运行在独立进程中，避免与被测代码争用 GIL。结果追加写入 BENCH_RESULTS，便于跨版本比较。
+
+用法: python benchmark.py（所有参数通过 BENCH_* 环境变量配置）
+"""
+import os
+import sys
+import io
+import re
+import json
+import time
+import uuid
+import zlib
+import random
+import socket
+import ipaddress
+import platform
+import tempfile
+import threading
+import subprocess
+import contextlib
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from typing import List, Dict, Tuple, Optional
+
+try:
+    import dns.edns
+    import dns.flags
+    import dns.message
+    import dns.rcode
+    import dns.rdatatype
+    import dns.rrset
+except ImportError:  # dnspython 只有域名解析（domain_ip.py）需要，未安装时跳过该项
+    dns = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BENCH_EDGE_PORT = int(os.environ.get("BENCH_EDGE_PORT", "18080"))
+BENCH_API_PORT = int(os.environ.get("BENCH_API_PORT", "18081"))
+BENCH_DNS_PORT = int(os.environ.get("BENCH_DNS_PORT", "18053"))
+BENCH_EDGE_CIDRS = os.environ.get("BENCH_EDGE_CIDRS", "127.10.0.0/16,127.20.0.0/16,127.30.0.0/16")
+BENCH_LATENCY_MS = float(os.environ.get("BENCH_LATENCY_MS", "20"))  # 每个IP的基础响应延迟
+BENCH_LATENCY_SPREAD_MS = float(os.environ.get("BENCH_LATENCY_SPREAD_MS", "80"))  # 不同IP之间的延迟差异上限
+BENCH_LOSS = float(os.environ.get("BENCH_LOSS", "0.02"))  # 请求被直接断开的概率
+BENCH_GOOD_RATIO = float(os.environ.get("BENCH_GOOD_RATIO", "0.5"))  # 返回期望状态码的IP比例
+BENCH_EXPECTED_STATUS = int(os.environ.get("BENCH_EXPECTED_STATUS", "403"))
+BENCH_BANDWIDTH_MBPS = float(os.environ.get("BENCH_BANDWIDTH_MBPS", "200"))  # 每个IP的下载带宽上限
+BENCH_COLOS = os.environ.get("BENCH_COLOS", "HKG:HK,SIN:SG,NRT:JP,LAX:US")  # 模拟节点分配的数据中心（colo:loc）
+BENCH_API_LATENCY_MS = float(os.environ.get("BENCH_API_LATENCY_MS", "30"))  # 模拟 DNS API 每个请求的延迟
+BENCH_PROBE_COUNT = int(os.environ.get("BENCH_PROBE_COUNT", "2000"))
+BENCH_GENERATE_COUNT = int(os.environ.get("BENCH_GENERATE_COUNT", "200000"))
+BENCH_DNS_RECORDS = int(os.environ.get("BENCH_DNS_RECORDS", "20"))
+BENCH_SPEED_TEST_COUNT = int(os.environ.get("BENCH_SPEED_TEST_COUNT", "3"))  # 参与下载测速的合格IP数量
+BENCH_DOMAIN_COUNT = int(os.environ.get("BENCH_DOMAIN_COUNT", "200"))  # 域名解析测试的域名数量
+BENCH_ECS_REGIONS = os.environ.get("BENCH_ECS_REGIONS", "hk=1.36.0.0/16,sg=43.245.0.0/16")  # 模拟DNS按这些ECS子网返回不同地址
+BENCH_SEED = int(os.environ.get("BENCH_SEED", "1"))
+BENCH_RESULTS = os.environ.get("BENCH_RESULTS", os.path.join(BASE_DIR, "benchmarks", "results.jsonl"))
+BENCH_LABEL = os.environ.get("BENCH_LABEL", "")  # 附加到结果中的说明，例如改动内容
+
+ECS_QUERIES = multiprocessing.Value('i', 0)  # 模拟DNS收到的携带ECS的查询数（跨进程共享）
+
+
+class EdgeProfile:
+    """按IP确定性地生成模拟边缘节点的表现"""
+
+    def __init__(self):
+        self.cache: Dict[str, Dict] = {}
+
+    def for_ip(self, ip: str) -> Dict:
+        profile = self.cache.get(ip)
+        if profile is None:
+            rng = random.Random(zlib.crc32(ip.encode()) ^ BENCH_SEED)
+            good = rng.random() < BENCH_GOOD_RATIO
+            profile = {
+                'latency': (BENCH_LATENCY_MS + rng.random() * BENCH_LATENCY_SPREAD_MS) / 1000,
+                'status': BENCH_EXPECTED_STATUS if good else rng.choice([200, 404, 502, 503]),
+                'bandwidth': BENCH_BANDWIDTH_MBPS * 125000 * (0.2 + 0.8 * rng.random()),  # 字节/秒
+                'colo': rng.choice([item.strip() for item in BENCH_COLOS.split(',') if item.strip()] or ['HKG:HK']),
+            }
+            self.cache[ip] = profile
+        return profile
+
+
+class EdgeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    profile = EdgeProfile()
+
+    def do_GET(self):
+        ip = self.connection.getsockname()[0]
+        profile = self.profile.for_ip(ip)
+        if random.random() < BENCH_LOSS:
+            # 模拟丢包：不返回任何内容直接断开
+            self.close_connection = True
+            return
+        time.sleep(profile['latency'])
+
+        url = urlsplit(self.path)
+        if url.path == '/__down':
+            total = int(parse_qs(url.query).get('bytes', ['1000000'])[0])
+            self.send_response(200)
+            self.send_header('Content-Length', str(total))
+            self.end_headers()
+            chunk = b'\0' * 65536
+            sent = 0
+            start = time.time()
+            try:
+                while sent < total:
+                    size = min(len(chunk), total - sent)
+                    self.wfile.write(chunk[:size])
+                    sent += size
+                    # 按带宽限速
+                    ahead = sent / profile['bandwidth'] - (time.time() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            except OSError:
+                self.close_connection = True
+            return
+
+        if url.path == '/cdn-cgi/trace':
+            colo, _, loc = profile['colo'].partition(':')
+            body = (f"fl=0f0\nh={self.headers.get('Host', '')}\nip={self.client_address[0]}\nts={time.time():.3f}\n"
+                    f"visit_scheme=http\nuag={self.headers.get('User-Agent', '')}\ncolo={colo}\n"
+                    f"http=http/1.1\nloc={loc or colo[:2]}\ntls=off\nsni=off\nwarp=off\n").encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        body = f'mock edge {ip}\n'.encode()
+        self.send_response(profile['status'])
+        self.send_header('Server', 'cloudflare')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    """最小化的 Cloudflare DNS API：列表（分页/过滤）、增删改、批量接口"""
+    protocol_version = 'HTTP/1.1'
+    records: Dict[str, Dict[str, Dict]] = {}
+    lock = threading.Lock()
+
+    def _send(self, code: int, payload: Dict):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def _handle(self, method: str):
+        time.sleep(BENCH_API_LATENCY_MS / 1000)
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        body = self._body() if method in ('POST', 'PUT', 'PATCH') else None
+        if method == 'GET' and url.path == '/domains.txt':
+            # domain_ip.py 的域名列表
+            text = ''.join(f'{domain}\n' for domain in bench_domains()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(text)))
+            self.end_headers()
+            self.wfile.write(text)
+            return
+        match = re.match(r'/client/v4/zones/([^/]+)/dns_records(?:/(.*))?$', url.path)
+        if not match:
+            return self._send(404, {'success': False, 'errors': [{'message': 'not found'}]})
+        zone, rest = match.group(1), match.group(2)
+
+        with self.lock:
+            records = self.records.setdefault(zone, {})
+            if method == 'GET' and not rest:
+                items = [r for r in records.values()
+                         if ('name' not in query or r['name'] == query['name'][0])
+                         and ('type' not in query or r['type'] == query['type'][0])]
+                per_page = int(query.get('per_page', ['20'])[0])
+                page = int(query.get('page', ['1'])[0])
+                total_pages = max(1, (len(items) + per_page - 1) // per_page)
+                return self._send(200, {
+                    'success': True,
+                    'result': items[(page - 1) * per_page:page * per_page],
+                    'result_info': {'page': page, 'per_page': per_page,
+                                    'total_pages': total_pages, 'total_count': len(items)},
+                })
+            if method == 'POST' and rest == 'batch':
+                result = {'deletes': [], 'patches': [], 'puts': [], 'posts': []}
+                for item in body.get('deletes', []):
+                    result['deletes'].append(records.pop(item['id']))
+                for item in body.get('patches', []):
+                    records[item['id']].update(item)
+                    result['patches'].append(records[item['id']])
+                for item in body.get('puts', []):
+                    records[item['id']] = dict(item)
+                    result['puts'].append(records[item['id']])
+                for item in body.get('posts', []):
+                    record = dict(item, id=uuid.uuid4().hex)
+                    records[record['id']] = record
+                    result['posts'].append(record)
+                return self._send(200, {'success': True, 'result': result})
+            if method == 'POST' and not rest:
+                record = dict(body, id=uuid.uuid4().hex)
+                records[record['id']] = record
+                return self._send(200, {'success': True, 'result': record})
+            if method in ('PUT', 'PATCH') and rest in records:
+                records[rest] = dict(body, id=rest) if method == 'PUT' else {**records[rest], **body}
+                return self._send(200, {'success': True, 'result': records[rest]})
+            if method == 'DELETE' and rest in records:
+                records.pop(rest)
+                return self._send(200, {'success': True, 'result': {'id': rest}})
+        return self._send(404, {'success': False, 'errors': [{'message': 'not found'}]})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_domains() -> List[str]:
+    return [f'd{index}.bench.example.com' for index in range(BENCH_DOMAIN_COUNT)]
+
+
+def ecs_regions() -> List[Tuple[str, ipaddress.IPv4Network]]:
+    """解析 BENCH_ECS_REGIONS，返回 [(地区, 子网)]"""
+    regions = []
+    for item in BENCH_ECS_REGIONS.split(','):
+        if item.strip():
+            region, _, subnet = item.strip().partition('=')
+            regions.append((region, ipaddress.ip_network(subnet, strict=False)))
+    return regions
+
+
+def stub_address(domain_index: int, region_index: int) -> str:
+    """模拟DNS返回的地址：落在 Cloudflare 的 104.16.0.0/13 中，第三段区分地区（0 表示未携带ECS）"""
+    return f'104.16.{region_index}.{domain_index % 250 + 1}'
+
+
+def serve_dns(host: str, port: int, ready, ecs_queries):
+    """在子进程中运行模拟DNS服务器（UDP）
+
+    A 记录按查询携带的ECS子网返回不同地区的地址，并在应答中回显ECS选项；
+    AAAA 记录返回空应答，其他域名返回 NXDOMAIN。ecs_queries 统计收到的携带ECS的查询数。
+    """
+    regions = ecs_regions()
+    domains = {f'{domain}.': index for index, domain in enumerate(bench_domains())}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    ready.set()
+    while True:
+        data, client = sock.recvfrom(4096)
+        try:
+            query = dns.message.from_wire(data)
+        except Exception:
+            continue
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        ecs = next((option for option in query.options if isinstance(option, dns.edns.ECSOption)), None)
+        region_index = 0
+        if ecs is not None:
+            with ecs_queries.get_lock():
+                ecs_queries.value += 1
+            address = ipaddress.ip_address(ecs.address)
+            region_index = next((i + 1 for i, (_, subnet) in enumerate(regions) if address in subnet), 0)
+            response.use_edns(0, 0, 1232, options=[dns.edns.ECSOption(ecs.address, ecs.srclen, ecs.srclen)])
+        domain_index = domains.get(question.name.to_text().lower())
+        if domain_index is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        elif question.rdtype == dns.rdatatype.A:
+            response.answer.append(dns.rrset.from_text(question.name, 300, 'IN', 'A',
+                                                       stub_address(domain_index, region_index)))
+        response.flags |= dns.flags.RA
+        sock.sendto(response.to_wire(), client)
+
+
+def serve_forever(handler, host: str, port: int, ready):
+    """在子进程中运行模拟服务"""
+    ThreadingHTTPServer.request_queue_size = 4096
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer((host, port), handler)
+    ready.set()
+    server.serve_forever()
+
+
+def start_servers() -> List[multiprocessing.Process]:
+    processes = []
+    for handler, host, port in ((EdgeHandler, '0.0.0.0', BENCH_EDGE_PORT), (MockAPIHandler, '127.0.0.1', BENCH_API_PORT)):
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=serve_forever, args=(handler, host, port, ready), daemon=True)
+        process.start()
+        if not ready.wait(10):
+            raise RuntimeError(f"模拟服务 {host}:{port} 启动失败")
+        processes.append(process)
+    if dns is not None:
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=serve_dns, args=('127.0.0.1', BENCH_DNS_PORT, ready, ECS_QUERIES),
+                                          daemon=True)
+        process.start()
+        if not ready.wait(10):
+            raise RuntimeError(f"模拟DNS服务 127.0.0.1:{BENCH_DNS_PORT} 启动失败")
+        processes.append(process)
+    return processes
+
+
+def configure_environment(workdir: str):
+    """在导入 cfip 之前把它指向模拟服务
+
+    会访问外部服务的配置（DNS API、Telegram 推送）总是被覆盖，保证基准测试不会修改真实记录或发送消息；
+    其余参数只在未显式设置时使用默认值。
+    """
+    forced = {
+        'CF_API_BASE': f'http://127.0.0.1:{BENCH_API_PORT}/client/v4',
+        'CF_API_TOKEN': 'benchmark-token',
+        'BOT_TOKEN': '',
+        'CHAT_ID': '',
+    }
+    os.environ.update(forced)
+    defaults = {
+        'TEST_URL_TEMPLATE': f'http://{{ip}}:{BENCH_EDGE_PORT}/',
+        'EXPECTED_STATUS_CODE': str(BENCH_EXPECTED_STATUS),
+        'CF_ZONE_ID': 'benchmark-zone',
+        'CF_DNS_NAME': 'bench.example.com',
+        'REQUEST_TIMEOUT': '2',
+        'GENERATE_IPV6': 'false',
+        'SEED_IP_FILES': '',
+        'DNS_TARGETS': '',
+        'IP_HISTORY_DB': os.path.join(workdir, 'ip_history.db'),
+        'RANGE_CACHE_DIR': os.path.join(workdir, 'range_cache'),
+        'SPEED_TEST_URL': f'http://speed.example.com:{BENCH_EDGE_PORT}/__down?bytes=5000000',
+        'TRACE_URL': f'http://trace.example.com:{BENCH_EDGE_PORT}/cdn-cgi/trace',
+        'DOMAIN_LIST_URL': f'http://127.0.0.1:{BENCH_API_PORT}/domains.txt',
+        'DNS_RESOLVERS': f'bench=127.0.0.1:{BENCH_DNS_PORT}',
+        'DNS_ECS_REGIONS': BENCH_ECS_REGIONS,
+        'DNS_CACHE_FILE': os.path.join(workdir, 'dns_cache.json'),
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_benchmarks() -> Dict:
+    import cfip
+
+    edge_cidrs = [cidr.strip() for cidr in BENCH_EDGE_CIDRS.split(',') if cidr.strip()]
+    # 地址范围直接指向模拟节点所在的回环网段，不访问网络
+    cfip.CloudflareIPManager._ranges = (edge_cidrs, [])
+    metrics = {}
+    quiet = contextlib.redirect_stdout(io.StringIO())
+
+    # 1. 候选IP生成速率
+    with open(os.path.join(BASE_DIR, 'cfasn'), 'r', encoding='utf-8') as file:
+        real_cidrs = [line.strip() for line in file if line.strip()]
+    strategies = ['stratified', 'bandit'] + (['vectorized'] if cfip.np is not None else [])
+    original_strategy = cfip.SEARCH_STRATEGY
+    for strategy in strategies:
+        cfip.SEARCH_STRATEGY = strategy
+        manager = cfip.CloudflareIPManager()
+        with quiet:
+            manager.get_sampler(real_cidrs, False)
+            (batch, _), elapsed = timed(manager.generate_candidate_batch, real_cidrs, BENCH_GENERATE_COUNT, False, set())
+        metrics[f'generate_{strategy}_ips_per_sec'] = round(len(batch) / elapsed, 1)
+    cfip.SEARCH_STRATEGY = original_strategy
+
+    # 2. 探测吞吐量
+    manager = cfip.CloudflareIPManager()
+    with quiet:
+        manager.get_sampler(edge_cidrs, False)
+        probe_ips, _ = manager.generate_candidate_batch(edge_cidrs, BENCH_PROBE_COUNT, False, set())
+        results, elapsed = timed(manager.test_multiple_ips_concurrently, probe_ips,
+                                 cfip.TEST_URL_TEMPLATE, cfip.EXPECTED_STATUS_CODE)
+    metrics['probe_thread_per_sec'] = round(len(probe_ips) / elapsed, 1)
+    metrics['probe_thread_qualified'] = sum(1 for result in results if result[1])
+    original_method = cfip.PROBE_METHOD
+    cfip.PROBE_METHOD = 'raw'
+    with quiet:
+        results, elapsed = timed(manager.test_multiple_ips_concurrently, probe_ips,
+                                 cfip.TEST_URL_TEMPLATE, cfip.EXPECTED_STATUS_CODE)
+    cfip.PROBE_METHOD = original_method
+    metrics['probe_raw_per_sec'] = round(len(probe_ips) / elapsed, 1)
+    metrics['probe_raw_qualified'] = sum(1 for result in results if result[1])
+    with quiet:
+        results, elapsed = timed(manager.test_multiple_ips_async, probe_ips,
+                                 cfip.TEST_URL_TEMPLATE, cfip.EXPECTED_STATUS_CODE)
+    metrics['probe_async_per_sec'] = round(len(probe_ips) / elapsed, 1)
+    qualified = [result[0] for result in results if result[1]]
+    trace_ips = qualified[:200]
+    with quiet:
+        traces, elapsed = timed(manager.trace_ips, trace_ips)
+    metrics['trace_per_sec'] = round(len(trace_ips) / max(elapsed, 1e-6), 1)
+    metrics['trace_with_colo'] = sum(1 for trace in traces.values() if trace['colo'])
+
+    # 3. 下载测速（模拟节点按IP限速，串行测速几个合格IP）
+    speed_ips = [{'ip': ip, 'score': 0.0} for ip in qualified[:BENCH_SPEED_TEST_COUNT]]
+    with quiet:
+        ranked, elapsed = timed(manager.speed_test_ips, speed_ips)
+    metrics['speed_test_seconds'] = elapsed
+    metrics['speed_test_best_mbps'] = round(ranked[0]['speed'], 2) if ranked else 0.0
+
+    # 4. DNS 更新耗时：先写入一组记录，再同步为另一组（约一半相同）
+    dns_manager = cfip.CloudflareDNSManager()
+    first = probe_ips[:BENCH_DNS_RECORDS]
+    second = probe_ips[BENCH_DNS_RECORDS // 2:BENCH_DNS_RECORDS // 2 + BENCH_DNS_RECORDS]
+    with quiet:
+        _, metrics['dns_create_seconds'] = timed(dns_manager.reconcile_dns_records, 'dns-bench.example.com', 'A', first)
+        _, metrics['dns_reconcile_seconds'] = timed(dns_manager.reconcile_dns_records, 'dns-bench.example.com', 'A', second)
+    dns_manager.session.close()
+
+    # 5. 端到端 main() 耗时
+    with quiet:
+        _, metrics['main_seconds'] = timed(cfip.main)
+
+    # 6. 域名解析：模拟DNS按ECS子网返回不同地址，检查ECS选项送达、地区标签写入 DOMAIN_REGIONS_FILE
+    if dns is None:
+        print("未安装 dnspython，跳过域名解析测试")
+    else:
+        import domain_ip
+        from ip_sources import read_json
+
+        queries_before = ECS_QUERIES.value
+        with quiet:
+            _, metrics['domain_resolve_seconds'] = timed(domain_ip.main)
+        metrics['domain_ecs_queries'] = ECS_QUERIES.value - queries_before
+        region_tags = read_json(domain_ip.DOMAIN_REGIONS_FILE, {})
+        expected = {stub_address(index, region_index + 1): [region]
+                    for index in range(BENCH_DOMAIN_COUNT) for region_index, (region, _) in enumerate(ecs_regions())}
+        metrics['domain_region_tags_ok'] = sum(1 for ip, tags in expected.items() if region_tags.get(ip) == tags)
+        if metrics['domain_region_tags_ok'] != len(expected) or len(region_tags) != len(expected):
+            print(f"警告: {domain_ip.DOMAIN_REGIONS_FILE} 中的地区标签与模拟DNS的应答不一致"
+                  f"（{metrics['domain_region_tags_ok']}/{len(expected)} 个正确，共 {len(region_tags)} 个IP）")
+
+    return {key: round(value, 4) if isinstance(value, float) else value for key, value in metrics.items()}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def load_previous(path: str) -> Optional[Dict]:
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            lines = [line for line in file if line.strip()]
+        return json.loads(lines[-1]) if lines else None
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    if not sys.platform.startswith('linux'):
+        print("警告: 回环网段 127.0.0.0/8 只有在 Linux 上才全部可用，其他系统可能无法连接模拟节点")
+
+    workdir = tempfile.mkdtemp(prefix='cfip-bench-')
+    configure_environment(workdir)
+    processes = start_servers()
+    original_cwd = os.getcwd()
+    os.chdir(workdir)  # main() 会写 cfip.txt 等文件，放到临时目录中
+    sys.path.insert(0, BASE_DIR)
+    try:
+        start = time.time()
+        metrics = run_benchmarks()
+        metrics['total_seconds'] = round(time.time() - start, 2)
+    finally:
+        os.chdir(original_cwd)
+        for process in processes:
+            process.terminate()
+
+    record = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'label': BENCH_LABEL,
+        'python': platform.python_version(),
+        'host': socket.gethostname(),
+        'config': {key: value for key, value in globals().items()
+                   if key.startswith('BENCH_') and key not in ('BENCH_RESULTS', 'BENCH_LABEL')},
+        'metrics': metrics,
+    }
+
+    previous = load_previous(BENCH_RESULTS)
+    print("基准测试结果:")
+    for key, value in metrics.items():
+        line = f"  {key}: {value}"
+        old = (previous or {}).get('metrics', {}).get(key)
+        if isinstance(old, (int, float)) and old:
+            line += f"  (上次 {old}，变化 {(value - old) / old:+.1%})"
+        print(line)
+
+    os.makedirs(os.path.dirname(os.path.abspath(BENCH_RESULTS)), exist_ok=True)
+    with open(BENCH_RESULTS, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f"结果已追加到 {BENCH_RESULTS}")
+
+
+if __name__ == '__main__':
+    main()
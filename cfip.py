@@ -1,12 +1,43 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 import ipaddress
 import random
 import traceback
+import logging
 import time
 import os
+import sys
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Dict, Tuple, Optional
+import csv
+import hashlib
+import tempfile
+import sqlite3
+import threading
+import heapq
+import math
+import statistics
+import asyncio
+import ssl
+import socket
+import errno
+import selectors
+import signal
+from bisect import bisect_right
+from collections import deque
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator
+
+from cidr_index import CIDRIndex, ip_to_int
+from ip_sources import SourceRegistry
+from metrics import METRICS
+
+try:
+    import numpy as np
+except ImportError:  # 未安装numpy时向量化生成不可用，回退到分层采样
+    np = None
 
 # 环境变量读取
 CF_API_TOKEN = os.environ.get("CF_API_TOKEN")
@@ -21,75 +52,698 @@ REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", "5"))
 GENERATE_IPV6 = os.environ.get("GENERATE_IPV6", "true").lower() == "true"
 IPV6_COUNT = int(os.environ.get("IPV6_COUNT", "3"))
 MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "10"))
+PROBE_ENGINE = os.environ.get("PROBE_ENGINE", "thread").lower()  # thread 或 asyncio
+PROBE_METHOD = os.environ.get("PROBE_METHOD", "requests").lower()  # 线程池引擎的探测方式: requests 或 raw（原始套接字，只读状态行）
+PROBE_HOST = os.environ.get("PROBE_HOST", "")  # 探测请求的 Host 头，留空则使用测试URL中的主机部分
+ASYNC_CONCURRENCY = int(os.environ.get("ASYNC_CONCURRENCY", "2000"))
+TCP_PREFILTER = os.environ.get("TCP_PREFILTER", "false").lower() == "true"
+TCP_PREFILTER_PORT = int(os.environ.get("TCP_PREFILTER_PORT", "0"))  # 0 表示按测试URL推断 80/443
+TCP_PREFILTER_CANDIDATES = int(os.environ.get("TCP_PREFILTER_CANDIDATES", "200"))
+TCP_CONNECT_TIMEOUT = float(os.environ.get("TCP_CONNECT_TIMEOUT", "2"))
+TCP_CONNECT_CONCURRENCY = int(os.environ.get("TCP_CONNECT_CONCURRENCY", "500"))
+PROBE_SAMPLES = int(os.environ.get("PROBE_SAMPLES", "0"))  # 每个合格IP额外的TCP握手计时采样次数，0 表示直接使用探测时测得的首字节耗时
+RANK_POOL_FACTOR = int(os.environ.get("RANK_POOL_FACTOR", "1"))  # 参与排名的合格IP数 = 目标数量 × 该系数，大于1时会多探测候选IP
+JITTER_WEIGHT = float(os.environ.get("JITTER_WEIGHT", "2"))
+LOSS_PENALTY_MS = float(os.environ.get("LOSS_PENALTY_MS", "1000"))
+SPEED_TEST = os.environ.get("SPEED_TEST", "false").lower() == "true"
+SPEED_TEST_URL = os.environ.get("SPEED_TEST_URL", "https://speed.cloudflare.com/__down?bytes=50000000")
+SPEED_TEST_COUNT = int(os.environ.get("SPEED_TEST_COUNT", "5"))  # 参与测速的入围IP数量
+SPEED_TEST_MAX_SECONDS = float(os.environ.get("SPEED_TEST_MAX_SECONDS", "5"))
+SPEED_TEST_MAX_BYTES = int(os.environ.get("SPEED_TEST_MAX_BYTES", str(50 * 1024 * 1024)))
+HTTPS_PROBE = os.environ.get("HTTPS_PROBE", "false").lower() == "true"  # 对合格IP做HTTPS探测，记录TCP/TLS握手耗时和所在数据中心
+TRACE_URL = os.environ.get("TRACE_URL", "https://www.cloudflare.com/cdn-cgi/trace")
+TRACE_SNI = os.environ.get("TRACE_SNI", "")  # HTTPS探测的 SNI 和 Host 头，留空则使用 TRACE_URL 中的域名
+PREFERRED_COLOS = [c.strip().upper() for c in os.environ.get("PREFERRED_COLOS", "").split(',') if c.strip()]  # 按顺序优先发布这些数据中心的IP，如 HKG,SIN
+EXCLUDED_COLOS = {c.strip().upper() for c in os.environ.get("EXCLUDED_COLOS", "").split(',') if c.strip()}  # 丢弃落在这些数据中心的IP
+IP_HISTORY_DB = os.environ.get("IP_HISTORY_DB", "ip_history.db")  # 留空则不记录历史
+HISTORY_MAX_AGE_DAYS = float(os.environ.get("HISTORY_MAX_AGE_DAYS", "7"))  # 超过该天数未成功的IP不再优先复测
+HISTORY_RETENTION_DAYS = float(os.environ.get("HISTORY_RETENTION_DAYS", "30"))
+STRATUM_PREFIX_V4 = int(os.environ.get("STRATUM_PREFIX_V4", "24"))  # IPv4按 /24 分层采样
+STRATUM_PREFIX_V6 = int(os.environ.get("STRATUM_PREFIX_V6", "96"))
+SEARCH_STRATEGY = os.environ.get("SEARCH_STRATEGY", "stratified").lower()  # stratified、bandit 或 vectorized
+BANDIT_LATENCY_SCALE_MS = float(os.environ.get("BANDIT_LATENCY_SCALE_MS", "200"))
+VECTOR_CHUNK_SIZE = int(os.environ.get("VECTOR_CHUNK_SIZE", "100000"))  # 向量化生成每块的候选数量
+SEED_IP_FILES = os.environ.get("SEED_IP_FILES", "ip.js,domain_ips.js")  # 采集到的候选IP文件，逗号分隔，留空不使用
+SEED_REGIONS = [r.strip() for r in os.environ.get("SEED_REGIONS", "").split(',') if r.strip()]  # 优先探测这些地区解析到的候选IP
+SEED_REGIONS_FILE = os.environ.get("SEED_REGIONS_FILE", "domain_ip_regions.json")  # domain_ip.py 生成的 IP -> 地区标签
+RANGE_CACHE_DIR = os.environ.get("RANGE_CACHE_DIR", ".cf_cache")
+RANGE_CACHE_TTL = int(os.environ.get("RANGE_CACHE_TTL", "86400"))  # 地址范围缓存有效期（秒）
+MONITOR_INTERVAL = float(os.environ.get("MONITOR_INTERVAL", "30"))  # 守护模式下复测已发布IP的间隔（秒）
+MONITOR_FAIL_THRESHOLD = int(os.environ.get("MONITOR_FAIL_THRESHOLD", "2"))  # 已发布IP连续失败多少次后替换
+MONITOR_POOL_SPARE = int(os.environ.get("MONITOR_POOL_SPARE", "5"))  # 每个地址族在发布数量之外保留的备用IP数
+REPLENISH_INTERVAL = float(os.environ.get("REPLENISH_INTERVAL", "900"))  # 后台刷新备用IP池的间隔（秒），备用不足时立即补充
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()  # DEBUG 时输出每个IP的探测结果
+RUN_MODE = os.environ.get("RUN_MODE", "search").lower()  # search、sweep 或 daemon
+SWEEP_CIDR_FILE = os.environ.get("SWEEP_CIDR_FILE", "cfasn")
+SWEEP_OUTPUT = os.environ.get("SWEEP_OUTPUT", "sweep_results.csv")
+SWEEP_RANKED_OUTPUT = os.environ.get("SWEEP_RANKED_OUTPUT", "sweep_ranked.csv")
+SWEEP_CHECKPOINT = os.environ.get("SWEEP_CHECKPOINT", "sweep_checkpoint.json")
+SWEEP_CHUNK_SIZE = int(os.environ.get("SWEEP_CHUNK_SIZE", "4096"))
+SWEEP_HTTP_CHECK = os.environ.get("SWEEP_HTTP_CHECK", "true").lower() == "true"
+SWEEP_SORT_CHUNK = int(os.environ.get("SWEEP_SORT_CHUNK", "200000"))  # 外部排序时每个有序块的行数
+DNS_MAX_WORKERS = int(os.environ.get("DNS_MAX_WORKERS", "8"))  # 并发调用Cloudflare API的线程数
+DNS_PAGE_SIZE = int(os.environ.get("DNS_PAGE_SIZE", "100"))  # 列出DNS记录时每页数量
+DNS_TARGETS = os.environ.get("DNS_TARGETS", "")  # JSON列表或JSON文件路径: [{"zone", "name", "type", "count"}, ...]
+CF_API_BASE = os.environ.get("CF_API_BASE", "https://api.cloudflare.com/client/v4").rstrip('/')
+DNS_BATCH = os.environ.get("DNS_BATCH", "true").lower() == "true"  # 优先使用批量DNS接口
+API_RATE_LIMIT = float(os.environ.get("API_RATE_LIMIT", "4"))  # Cloudflare API 每秒请求数（全局限额约 1200次/5分钟）
+API_BURST = int(os.environ.get("API_BURST", "8"))
+RANKED_IPS_FILE = os.environ.get("RANKED_IPS_FILE", "")  # 指定后直接从扫描排名表中选取IP发布
+BANDIT_STATS_FILE = os.environ.get("BANDIT_STATS_FILE", "")  # 可包含 {family} 占位符，分别写入 ipv4/ipv6 统计
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RANGE_SOURCES = {
+    # 地址族: (远端地址, 离线时回退的仓库内文件)
+    'IPv4': ("https://www.cloudflare.com/ips-v4/", "cfasn"),
+    'IPv6': ("https://raw.githubusercontent.com/leung7963/CFIPS/main/cfipv6", "cfipv6"),
+}
+
+logger = logging.getLogger('cfip')
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
+def probe_outcome(success: bool, status_code: int, reason: str) -> str:
+    """把探测结果归类为 ok / status_mismatch / Timeout / Connection Error / error，用于计数"""
+    if success:
+        return 'ok'
+    if status_code:
+        return 'status_mismatch'
+    if reason in ('Timeout', 'Connection Error'):
+        return reason
+    return 'error'
+
+def raise_fd_limit():
+    """尽量提高进程可打开的文件描述符上限，以支撑数千个并发连接"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = max(soft, 65536) if hard == resource.RLIM_INFINITY else hard
+        if target > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def build_get_request(url: str, host: str = '', sni: str = '') -> Tuple[str, int, Optional[str], bytes]:
+    """为原始套接字请求构建最小的 HTTP/1.1 GET 报文，返回 (URL中的主机, 端口, TLS主机名, 请求报文)
+    
+    host 指定 Host 头，默认为URL中的主机和端口；sni 指定TLS主机名，默认为URL中的主机，非HTTPS时为 None。
+    """
+    parts = urlsplit(url)
+    use_tls = parts.scheme == 'https'
+    port = parts.port or (443 if use_tls else 80)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    request = (
+        f"GET {path} HTTP/1.1\r\n"
+        f"Host: {host or parts.netloc}\r\n"
+        f"User-Agent: {USER_AGENT}\r\n"
+        f"Accept: */*\r\n"
+        f"Connection: close\r\n\r\n"
+    ).encode('ascii')
+    return parts.hostname, port, (sni or parts.hostname) if use_tls else None, request
+
+class Deadline:
+    """一次请求的总时限：每个阻塞操作前用 remaining() 设置套接字超时，时限已过时抛出 socket.timeout"""
+    
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+    
+    def remaining(self) -> float:
+        left = self.expires - time.monotonic()
+        if left <= 0:
+            raise socket.timeout()
+        return left
+
+class IPHistoryStore:
+    """基于SQLite的IP探测历史，记录每个IP的最近延迟、成功率和最后探测时间"""
+    
+    def __init__(self, path: str = IP_HISTORY_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS ip_history (
+                    ip TEXT PRIMARY KEY,
+                    is_ipv6 INTEGER NOT NULL,
+                    last_rtt REAL,
+                    success_count INTEGER NOT NULL DEFAULT 0,
+                    probe_count INTEGER NOT NULL DEFAULT 0,
+                    last_seen REAL NOT NULL,
+                    last_success REAL
+                )"""
+            )
+            # 清理长期未探测的记录，保持文件紧凑
+            self.conn.execute(
+                "DELETE FROM ip_history WHERE last_seen < ?",
+                (time.time() - HISTORY_RETENTION_DAYS * 86400,)
+            )
+    
+    def record_results(self, results: List[Tuple[str, bool, Optional[float]]]):
+        """批量写入一轮探测结果: (ip, 是否合格, 延迟毫秒或None)"""
+        now = time.time()
+        rows = [
+            (ip, int(':' in ip), rtt, int(success), now, now if success else None)
+            for ip, success, rtt in results
+        ]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT INTO ip_history (ip, is_ipv6, last_rtt, success_count, probe_count, last_seen, last_success)
+                VALUES (?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT(ip) DO UPDATE SET
+                    last_rtt = COALESCE(excluded.last_rtt, ip_history.last_rtt),
+                    success_count = ip_history.success_count + excluded.success_count,
+                    probe_count = ip_history.probe_count + 1,
+                    last_seen = excluded.last_seen,
+                    last_success = COALESCE(excluded.last_success, ip_history.last_success)""",
+                rows
+            )
+    
+    def known_good(self, is_ipv6: bool, limit: int, max_age_days: float = HISTORY_MAX_AGE_DAYS) -> List[str]:
+        """返回近期成功过的IP，按成功率降序、延迟升序排列"""
+        with self.lock:
+            rows = self.conn.execute(
+                """SELECT ip FROM ip_history
+                WHERE is_ipv6 = ? AND success_count > 0 AND last_success >= ?
+                ORDER BY CAST(success_count AS REAL) / probe_count DESC, last_rtt IS NULL, last_rtt ASC
+                LIMIT ?""",
+                (int(is_ipv6), time.time() - max_age_days * 86400, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class CIDRSampler:
+    """跨全部CIDR的分层无放回采样器
+    
+    把所有网段合并去重后按 /24（IPv6 默认 /96）切分为分层，用整数前缀和索引定位分层，
+    不展开任何地址。每一轮按仿射置换 (a*i + c) mod N 遍历全部分层，保证每个分层各被采样一次后
+    才进入下一轮；分层内部同样按各自的仿射置换遍历主机地址，状态只为抽取过的分层按需创建，
+    整体做到无放回，且只有全部地址都抽取完才返回 None。
+    """
+    
+    def __init__(self, cidrs: List[str], is_ipv6: bool = False, stratum_prefix: Optional[int] = None):
+        version = 6 if is_ipv6 else 4
+        networks = []
+        for cidr in cidrs:
+            try:
+                network = ipaddress.ip_network(cidr.strip(), strict=False)
+            except ValueError:
+                continue
+            if network.version == version:
+                networks.append(network)
+        
+        self.is_ipv6 = is_ipv6
+        self.address_class = ipaddress.IPv6Address if is_ipv6 else ipaddress.IPv4Address
+        self.stratum_prefix = stratum_prefix or (STRATUM_PREFIX_V6 if is_ipv6 else STRATUM_PREFIX_V4)
+        max_bits = 128 if is_ipv6 else 32
+        
+        # 每个网段的起始地址、分层主机位数，以及分层数/地址数的前缀和
+        self.starts = []
+        self.host_bits = []
+        self.stratum_offsets = []
+        self.address_offsets = []
+        self.total_strata = 0
+        self.total_addresses = 0
+        for network in ipaddress.collapse_addresses(networks):
+            prefix = max(network.prefixlen, self.stratum_prefix)
+            self.starts.append(int(network.network_address))
+            self.host_bits.append(max_bits - prefix)
+            self.stratum_offsets.append(self.total_strata)
+            self.address_offsets.append(self.total_addresses)
+            self.total_strata += 1 << (prefix - network.prefixlen)
+            self.total_addresses += network.num_addresses
+        
+        # 分层编号 -> [乘数, 增量, 已抽取数]，即该分层内主机地址的置换遍历状态
+        self.walks: Dict[int, List[int]] = {}
+        self.exhausted_strata = 0
+        self.drawn = 0
+        self._new_pass()
+    
+    @staticmethod
+    def _coprime_multiplier(n: int) -> int:
+        """随机选取与 n 互素的乘数，(a*i + c) mod n 即为 0..n-1 的一个置换"""
+        if n <= 2:
+            return 1
+        multiplier = random.randrange(1, n)
+        while math.gcd(multiplier, n) != 1:
+            multiplier = random.randrange(1, n)
+        return multiplier
+    
+    def _new_pass(self):
+        """开始新一轮分层遍历"""
+        n = max(self.total_strata, 1)
+        self.multiplier = self._coprime_multiplier(n)
+        self.increment = random.randrange(n)
+        self.position = 0
+    
+    def draw(self) -> Optional[str]:
+        """抽取下一个未抽取过的地址，所有分层都已取尽时返回 None"""
+        while self.exhausted_strata < self.total_strata:
+            if self.position >= self.total_strata:
+                self._new_pass()
+            stratum = (self.multiplier * self.position + self.increment) % self.total_strata
+            self.position += 1
+            
+            ip = self.draw_from_stratum(stratum)
+            if ip:
+                return ip
+        
+        return None
+    
+    def draw_from_stratum(self, stratum: int) -> Optional[str]:
+        """按该分层的置换抽取下一个地址，分层已取尽时返回 None"""
+        index = bisect_right(self.stratum_offsets, stratum) - 1
+        size = 1 << self.host_bits[index]
+        base = (stratum - self.stratum_offsets[index]) * size
+        # 分层足够大时避开首尾地址（网络地址/广播地址）
+        first, count = (1, size - 2) if size >= 4 else (0, size)
+        
+        walk = self.walks.get(stratum)
+        if walk is None:
+            walk = self.walks[stratum] = [self._coprime_multiplier(count), random.randrange(count), 0]
+        multiplier, increment, position = walk
+        if position >= count:
+            return None
+        walk[2] += 1
+        if walk[2] == count:
+            self.exhausted_strata += 1
+        
+        self.drawn += 1
+        offset = base + first + (multiplier * position + increment) % count
+        return str(self.address_class(self.starts[index] + offset))
+    
+    def stratum_of(self, ip_address: str) -> Optional[int]:
+        """返回地址所在分层的编号，不在索引范围内时返回 None"""
+        try:
+            value = int(self.address_class(ip_address))
+        except ValueError:
+            return None
+        index = bisect_right(self.starts, value) - 1
+        if index < 0:
+            return None
+        offset = value - self.starts[index]
+        next_offset = self.stratum_offsets[index + 1] if index + 1 < len(self.stratum_offsets) else self.total_strata
+        stratum = self.stratum_offsets[index] + (offset >> self.host_bits[index])
+        return stratum if stratum < next_offset else None
+    
+    def stratum_label(self, stratum: int) -> str:
+        """返回分层对应的CIDR表示"""
+        index = bisect_right(self.stratum_offsets, stratum) - 1
+        host_bits = self.host_bits[index]
+        start = self.starts[index] + ((stratum - self.stratum_offsets[index]) << host_bits)
+        return f"{self.address_class(start)}/{(128 if self.is_ipv6 else 32) - host_bits}"
+
+class SubnetBandit:
+    """在分层（/24）粒度上做 Thompson 采样的自适应探索策略
+    
+    每个已探测分层维护 Beta(成功+1, 失败+1) 后验，并按平均延迟折算；
+    另有一个代表“尚未探测的新分层”的先验臂，被选中时从采样器的置换顺序中取新分层。
+    """
+    
+    def __init__(self, sampler: CIDRSampler):
+        self.sampler = sampler
+        # 分层编号 -> [探测次数, 成功次数, 延迟总和, 延迟样本数]
+        self.stats: Dict[int, List[float]] = {}
+        self.exhausted = set()
+    
+    def _latency_factor(self, rtt_sum: float, rtt_count: float) -> float:
+        if not rtt_count:
+            return 1.0
+        return BANDIT_LATENCY_SCALE_MS / (BANDIT_LATENCY_SCALE_MS + rtt_sum / rtt_count)
+    
+    def choose(self) -> Optional[str]:
+        """选择一个分层并在其中抽取候选IP"""
+        total_rtt = sum(stat[2] for stat in self.stats.values())
+        total_rtt_count = sum(stat[3] for stat in self.stats.values())
+        best_value = random.betavariate(1, 1) * self._latency_factor(total_rtt, total_rtt_count)
+        best_stratum = None
+        
+        for stratum, (probes, successes, rtt_sum, rtt_count) in self.stats.items():
+            if stratum in self.exhausted:
+                continue
+            value = random.betavariate(successes + 1, probes - successes + 1) * self._latency_factor(rtt_sum, rtt_count)
+            if value > best_value:
+                best_value, best_stratum = value, stratum
+        
+        if best_stratum is not None:
+            ip = self.sampler.draw_from_stratum(best_stratum)
+            if ip:
+                return ip
+            self.exhausted.add(best_stratum)
+        
+        return self.sampler.draw()
+    
+    def update(self, ip_address: str, success: bool, rtt: Optional[float] = None):
+        """记录一次探测结果"""
+        stratum = self.sampler.stratum_of(ip_address)
+        if stratum is None:
+            return
+        stat = self.stats.setdefault(stratum, [0, 0, 0.0, 0])
+        stat[0] += 1
+        stat[1] += int(success)
+        if rtt is not None:
+            stat[2] += rtt
+            stat[3] += 1
+    
+    def dump_stats(self, limit: int = 10, path: str = "") -> List[Dict]:
+        """输出各分层获得的探测次数、成功次数和平均延迟，按探测次数降序"""
+        rows = [
+            {
+                'subnet': self.sampler.stratum_label(stratum),
+                'probes': int(probes),
+                'successes': int(successes),
+                'avg_rtt': rtt_sum / rtt_count if rtt_count else None,
+            }
+            for stratum, (probes, successes, rtt_sum, rtt_count) in self.stats.items()
+        ]
+        rows.sort(key=lambda row: (-row['probes'], -row['successes']))
+        
+        print(f"分层探测统计: 共探测 {len(rows)} 个分层，探测最多的 {min(limit, len(rows))} 个:")
+        for row in rows[:limit]:
+            rtt = f"{row['avg_rtt']:.1f}ms" if row['avg_rtt'] is not None else "-"
+            print(f"  {row['subnet']}: 探测 {row['probes']} 次，成功 {row['successes']} 次，平均延迟 {rtt}")
+        
+        if path:
+            try:
+                with open(path, 'w', encoding='utf-8') as file:
+                    json.dump(rows, file, ensure_ascii=False, indent=2)
+            except OSError as e:
+                print(f"保存分层探测统计失败: {e}")
+        return rows
+
+class LazyIPList:
+    """以整数数组保存的IP列表，仅在取出元素时才格式化为字符串"""
+    
+    def __init__(self, values, is_ipv6: bool = False):
+        # IPv4 为 uint32 一维数组；IPv6 为 (n, 2) 的 uint64 数组，两列分别是高/低64位
+        self.values = values
+        self.is_ipv6 = is_ipv6
+    
+    def __len__(self) -> int:
+        return len(self.values)
+    
+    def __getitem__(self, index: int) -> str:
+        if self.is_ipv6:
+            hi, lo = self.values[index]
+            return str(ipaddress.IPv6Address((int(hi) << 64) | int(lo)))
+        return str(ipaddress.IPv4Address(int(self.values[index])))
+    
+    def __iter__(self) -> Iterator[str]:
+        for index in range(len(self.values)):
+            yield self[index]
+
+class VectorizedIPGenerator:
+    """基于NumPy的批量候选IP生成器
+    
+    所有CIDR只解析一次：IPv4 存为 uint32 网络地址/主机掩码数组，IPv6 存为成对的 uint64 数组。
+    生成时按网段大小加权选择网段，用掩码一次性拼出随机地址，再排序去重并打乱顺序。
+    """
+    
+    def __init__(self, cidrs: List[str], is_ipv6: bool = False):
+        if np is None:
+            raise RuntimeError("向量化生成需要安装 numpy")
+        
+        version = 6 if is_ipv6 else 4
+        networks = []
+        for cidr in cidrs:
+            try:
+                network = ipaddress.ip_network(cidr.strip(), strict=False)
+            except ValueError:
+                continue
+            if network.version == version:
+                networks.append(network)
+        networks = list(ipaddress.collapse_addresses(networks))
+        
+        self.is_ipv6 = is_ipv6
+        self.rng = np.random.default_rng()
+        # 按地址数量加权；IPv6 网段可能极大，使用浮点权重
+        self.cumulative_weights = np.cumsum([float(network.num_addresses) for network in networks])
+        
+        if is_ipv6:
+            lo_mask = (1 << 64) - 1
+            self.net_hi = np.array([int(n.network_address) >> 64 for n in networks], dtype=np.uint64)
+            self.net_lo = np.array([int(n.network_address) & lo_mask for n in networks], dtype=np.uint64)
+            self.mask_hi = np.array([int(n.hostmask) >> 64 for n in networks], dtype=np.uint64)
+            self.mask_lo = np.array([int(n.hostmask) & lo_mask for n in networks], dtype=np.uint64)
+        else:
+            self.net = np.array([int(n.network_address) for n in networks], dtype=np.uint32)
+            self.mask = np.array([int(n.hostmask) for n in networks], dtype=np.uint32)
+        
+        self.chunk = None
+        self.position = 0
+    
+    def _random_words(self, count: int, dtype):
+        return self.rng.integers(0, np.iinfo(dtype).max, size=count, dtype=dtype, endpoint=True)
+    
+    def generate(self, count: int) -> LazyIPList:
+        """一次性生成最多 count 个去重后的随机候选IP"""
+        if not len(self.cumulative_weights) or count <= 0:
+            return LazyIPList(np.empty((0, 2) if self.is_ipv6 else 0, dtype=np.uint64 if self.is_ipv6 else np.uint32), self.is_ipv6)
+        
+        total = self.cumulative_weights[-1]
+        index = np.searchsorted(self.cumulative_weights, self.rng.random(count) * total, side='right')
+        index = np.minimum(index, len(self.cumulative_weights) - 1)
+        
+        if self.is_ipv6:
+            hi = self.net_hi[index] | (self._random_words(count, np.uint64) & self.mask_hi[index])
+            lo = self.net_lo[index] | (self._random_words(count, np.uint64) & self.mask_lo[index])
+            # 只有整个主机部分在低64位时才需要排除网络地址/广播地址
+            host_lo = lo & self.mask_lo[index]
+            keep = (self.mask_hi[index] != 0) | (self.mask_lo[index] < 3) | ((host_lo != 0) & (host_lo != self.mask_lo[index]))
+            hi, lo = hi[keep], lo[keep]
+            # 按 (高64位, 低64位) 排序后比较相邻元素去重
+            order = np.lexsort((lo, hi))
+            hi, lo = hi[order], lo[order]
+            unique = np.ones(len(hi), dtype=bool)
+            unique[1:] = (hi[1:] != hi[:-1]) | (lo[1:] != lo[:-1])
+            values = np.stack([hi[unique], lo[unique]], axis=1)
+        else:
+            mask = self.mask[index]
+            values = self.net[index] | (self._random_words(count, np.uint32) & mask)
+            host = values & mask
+            keep = (mask < 3) | ((host != 0) & (host != mask))
+            # 排序后比较相邻元素去重，比哈希去重快得多
+            values = np.sort(values[keep])
+            unique = np.ones(len(values), dtype=bool)
+            unique[1:] = values[1:] != values[:-1]
+            values = values[unique]
+        
+        # 去重后的结果有序，打乱后避免按地址顺序集中探测同一网段
+        values = values[self.rng.permutation(len(values))]
+        return LazyIPList(values, self.is_ipv6)
+    
+    def draw(self) -> Optional[str]:
+        """从预先生成的候选块中逐个取出IP，块用完后再生成下一块"""
+        if self.chunk is None or self.position >= len(self.chunk):
+            self.chunk = self.generate(VECTOR_CHUNK_SIZE)
+            self.position = 0
+            if not len(self.chunk):
+                return None
+        
+        ip = self.chunk[self.position]
+        self.position += 1
+        return ip
 
 class CloudflareIPManager:
-    def __init__(self):
+    # 地址范围列表在进程内只加载一次，所有实例共享
+    _ranges: Optional[Tuple[List[str], List[str]]] = None
+    _ranges_lock = threading.Lock()
+    _cidr_index: Optional[CIDRIndex] = None
+    _ssl_context: Optional[ssl.SSLContext] = None
+    
+    def __init__(self, history: Optional[IPHistoryStore] = None, sources: Optional[SourceRegistry] = None):
+        self.history = history
+        self.sources = sources
+        # 本次选中的候选IP及其来源，探测后据此回写来源统计
+        self.seed_sources: Dict[str, List[str]] = {}
         self.session = requests.Session()
         self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            'User-Agent': USER_AGENT
         })
+        # 最近一次TCP握手测得的延迟（毫秒）
+        self.tcp_latency: Dict[str, float] = {}
+        # 最近一次状态码探测从发起请求到收到状态行的耗时（毫秒），评分默认直接使用
+        self.probe_latency: Dict[str, float] = {}
+        # 已评分IP的质量数据: ip -> {'ip', 'rtt', 'jitter', 'loss', 'score'[, 'speed']}
+        self.ip_scores: Dict[str, Dict] = {}
+        # HTTPS探测结果: ip -> {'ip', 'tcp_ms', 'tls_ms', 'ttfb_ms', 'status', 'colo', 'loc', 'error'}
+        self.ip_traces: Dict[str, Dict] = {}
+        # 本次运行内复用的采样器，保证同一分层在一轮内不会重复采样
+        self.samplers: Dict[bool, Tuple[Tuple[str, ...], CIDRSampler]] = {}
+        self.bandits: Dict[bool, SubnetBandit] = {}
+        self.vector_generators: Dict[bool, VectorizedIPGenerator] = {}
     
+    def load_seed_ips(self, is_ipv6: bool, limit: int) -> List[str]:
+        """读取 collect_ips.py / domain_ip.py 采集到的候选IP
+        
+        用 cfasn / cfipv6 构建的地址范围索引校验，丢弃不属于Cloudflare的地址。配置了来源登记表时，
+        按各来源的历史合格率分配探测预算；每个来源内部按网段轮流选取，使预算覆盖尽量多的网段。
+        """
+        paths = [path.strip() for path in SEED_IP_FILES.split(',') if path.strip()]
+        if not paths or limit <= 0:
+            return []
+        
+        candidates = []
+        origins: Dict[str, List[str]] = {}
+        provenance = self.sources.load_provenance() if self.sources else {}
+        for path in paths:
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    for line in file:
+                        ip = line.strip()
+                        parsed = ip_to_int(ip)
+                        if parsed is None or (parsed[0] == 6) != is_ipv6:
+                            continue
+                        candidates.append(ip)
+                        if ip not in origins:
+                            origins[ip] = provenance.get(ip, {}).get('sources') or [os.path.basename(path)]
+            except OSError:
+                continue
+        if not candidates:
+            return []
+        
+        with CloudflareIPManager._ranges_lock:
+            if CloudflareIPManager._cidr_index is None:
+                CloudflareIPManager._cidr_index = CIDRIndex.from_files(
+                    [os.path.join(BASE_DIR, 'cfasn'), os.path.join(BASE_DIR, 'cfipv6')]
+                )
+        buckets, rejected = CloudflareIPManager._cidr_index.bucket(candidates)
+        ordered = CIDRIndex.interleave(buckets)
+        
+        if SEED_REGIONS:
+            # 目标用户所在地区的解析器/ECS视角下得到的IP排在前面
+            try:
+                with open(SEED_REGIONS_FILE, 'r', encoding='utf-8') as file:
+                    region_tags = json.load(file)
+            except (OSError, ValueError) as e:
+                print(f"读取地区标签 {SEED_REGIONS_FILE} 失败: {e}")
+                region_tags = {}
+            preferred = set(SEED_REGIONS)
+            ordered.sort(key=lambda ip: preferred.isdisjoint(region_tags.get(ip, ())))
+        
+        if self.sources:
+            # 每个IP归入权重最高的来源，再按来源权重分配名额
+            groups: Dict[str, List[str]] = {}
+            for ip in ordered:
+                best = max(origins[ip], key=self.sources.source_weight)
+                groups.setdefault(best, []).append(ip)
+            seeds = self.sources.allocate(groups, limit)
+        else:
+            seeds = ordered[:limit]
+        for ip in seeds:
+            self.seed_sources[ip] = origins[ip]
+        
+        print(f"候选IP文件中有 {len(candidates)} 个{'IPv6' if is_ipv6 else 'IPv4'}地址，"
+              f"{len(rejected)} 个不在地址范围内，选取 {len(seeds)} 个（覆盖 {len(buckets)} 个网段）")
+        return seeds
+    
+    @METRICS.timed('range_fetch')
     def get_cloudflare_ips(self) -> Tuple[List[str], List[str]]:
-        """从Cloudflare获取IPv4和IPv6地址范围"""
-        ipv4_url = "https://www.cloudflare.com/ips-v4/"
-        ipv6_url = "https://raw.githubusercontent.com/leung7963/CFIPS/main/cfipv6"
+        """从Cloudflare获取IPv4和IPv6地址范围
         
-        ipv4_cidrs = []
-        ipv6_cidrs = []
+        两个列表并发获取，每个进程只加载一次；磁盘缓存在 RANGE_CACHE_TTL 内直接使用，
+        过期后用 ETag/Last-Modified 发起条件请求；网络不可用时依次回退到过期缓存和仓库中的
+        cfasn / cfipv6 文件。
+        """
+        with CloudflareIPManager._ranges_lock:
+            if CloudflareIPManager._ranges is None:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    ipv4_future = executor.submit(self._load_range_list, 'IPv4', *RANGE_SOURCES['IPv4'])
+                    ipv6_future = executor.submit(self._load_range_list, 'IPv6', *RANGE_SOURCES['IPv6'])
+                    CloudflareIPManager._ranges = (ipv4_future.result(), ipv6_future.result())
+            ipv4_cidrs, ipv6_cidrs = CloudflareIPManager._ranges
         
+        return list(ipv4_cidrs), list(ipv6_cidrs)
+    
+    def _load_range_list(self, label: str, url: str, fallback_file: str) -> List[str]:
+        """加载单个地址范围列表：新鲜缓存 -> 条件请求 -> 过期缓存 -> 仓库内文件"""
+        def parse(text: str) -> List[str]:
+            return [line.strip() for line in text.splitlines() if line.strip()]
+        
+        cache_key = label.lower()
+        text_path = os.path.join(RANGE_CACHE_DIR, f"{cache_key}.txt")
+        meta_path = os.path.join(RANGE_CACHE_DIR, f"{cache_key}.json")
+        
+        meta = {}
+        cached = None
         try:
-            # 获取IPv4地址范围
-            response = self.session.get(ipv4_url, timeout=10)
-            response.raise_for_status()
-            ipv4_cidrs = [line.strip() for line in response.text.splitlines() if line.strip()]
-            print(f"获取到 {len(ipv4_cidrs)} 个IPv4 CIDR范围")
-        except requests.RequestException as e:
-            print(f"获取IPv4地址范围失败: {e}")
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            with open(text_path, 'r', encoding='utf-8') as file:
+                cached = file.read()
+        except (OSError, ValueError):
+            meta, cached = {}, None
+        if meta.get('url') != url:
+            meta, cached = {}, None
+        
+        if cached is not None and time.time() - meta.get('fetched_at', 0) < RANGE_CACHE_TTL:
+            cidrs = parse(cached)
+            print(f"获取到 {len(cidrs)} 个{label} CIDR范围（本地缓存）")
+            return cidrs
+        
+        headers = {}
+        if cached is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
         
         try:
-            # 获取IPv6地址范围
-            response = self.session.get(ipv6_url, timeout=10)
+            response = self.session.get(url, headers=headers, timeout=10)
+            if response.status_code == 304 and cached is not None:
+                cidrs = parse(cached)
+                meta['fetched_at'] = time.time()
+                self._save_range_cache(text_path, meta_path, None, meta)
+                print(f"获取到 {len(cidrs)} 个{label} CIDR范围（远端未变化）")
+                return cidrs
+            
             response.raise_for_status()
-            ipv6_cidrs = [line.strip() for line in response.text.splitlines() if line.strip()]
-            print(f"获取到 {len(ipv6_cidrs)} 个IPv6 CIDR范围")
+            cidrs = parse(response.text)
+            if cidrs:
+                meta = {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched_at': time.time(),
+                }
+                self._save_range_cache(text_path, meta_path, response.text, meta)
+                print(f"获取到 {len(cidrs)} 个{label} CIDR范围")
+                return cidrs
         except requests.RequestException as e:
-            print(f"获取IPv6地址范围失败: {e}")
+            print(f"获取{label}地址范围失败: {e}")
         
-        return ipv4_cidrs, ipv6_cidrs
+        if cached is not None:
+            cidrs = parse(cached)
+            print(f"使用过期的{label}地址范围缓存: {len(cidrs)} 个CIDR")
+            return cidrs
+        
+        try:
+            with open(os.path.join(BASE_DIR, fallback_file), 'r', encoding='utf-8') as file:
+                cidrs = parse(file.read())
+            print(f"使用仓库内的 {fallback_file} 文件: {len(cidrs)} 个{label} CIDR")
+            return cidrs
+        except OSError as e:
+            print(f"读取 {fallback_file} 失败: {e}")
+        return []
     
-    def generate_random_ip_from_cidr(self, cidr: str, is_ipv6: bool = False) -> Optional[str]:
-        """从CIDR范围内生成随机IP地址"""
+    @staticmethod
+    def _save_range_cache(text_path: str, meta_path: str, text: Optional[str], meta: Dict):
+        """写入地址范围缓存，text 为 None 时只刷新元数据"""
         try:
-            network = ipaddress.ip_network(cidr, strict=False)
-            
-            # 检查网络类型是否匹配
-            if is_ipv6 and network.version != 6:
-                return None
-            elif not is_ipv6 and network.version != 4:
-                return None
-            
-            # 计算网络地址和广播地址
-            network_address = int(network.network_address)
-            broadcast_address = int(network.broadcast_address)
-            
-            # 对于小网络，使用整个范围
-            if network.prefixlen <= (126 if is_ipv6 else 30):
-                start_ip = network_address + 1
-                end_ip = broadcast_address - 1
-            else:
-                start_ip = network_address
-                end_ip = broadcast_address
-            
-            # 生成随机IP
-            random_ip_int = random.randint(start_ip, end_ip)
-            random_ip = ipaddress.ip_address(random_ip_int)
-            
-            return str(random_ip)
-        except Exception:
-            return None
+            os.makedirs(RANGE_CACHE_DIR, exist_ok=True)
+            if text is not None:
+                with open(text_path, 'w', encoding='utf-8') as file:
+                    file.write(text)
+            with open(meta_path, 'w', encoding='utf-8') as file:
+                json.dump(meta, file)
+        except OSError as e:
+            print(f"写入地址范围缓存失败: {e}")
     
     def test_ip_status(self, ip_address: str, test_url_template: str, expected_status_code: int = 403) -> Tuple[bool, int, str, bool]:
         """测试IP地址是否返回指定状态码"""
+        start = time.perf_counter()
         try:
             # 判断是否为IPv6地址
             try:
@@ -112,134 +766,1159 @@ class CloudflareIPManager:
             )
             
             status_code = response.status_code
-            print(f"测试 IP {ip_address}: 状态码 {status_code}")
+            # elapsed 为发出请求到解析完响应头的耗时，不含读取响应体
+            self.probe_latency[ip_address] = response.elapsed.total_seconds() * 1000
+            logger.debug(f"测试 IP {ip_address}: 状态码 {status_code}")
             
             return status_code == expected_status_code, status_code, response.reason, is_ipv6
             
         except requests.exceptions.Timeout:
-            print(f"测试 IP {ip_address}: 请求超时")
+            logger.debug(f"测试 IP {ip_address}: 请求超时")
             return False, 0, "Timeout", False
         except requests.exceptions.ConnectionError:
-            print(f"测试 IP {ip_address}: 连接错误")
+            logger.debug(f"测试 IP {ip_address}: 连接错误")
             return False, 0, "Connection Error", False
         except Exception as e:
-            print(f"测试 IP {ip_address} 时发生异常: {str(e)}")
+            logger.debug(f"测试 IP {ip_address} 时发生异常: {str(e)}")
             return False, 0, str(e), False
+        finally:
+            METRICS.observe('probe_latency_ms', (time.perf_counter() - start) * 1000)
     
-    def test_multiple_ips_concurrently(self, ip_addresses: List[str], test_url_template: str, expected_status_code: int = 403) -> List[Tuple[str, bool]]:
-        """并发测试多个IP地址"""
+    def probe_ip_status(self, ip_address: str, test_url_template: str, expected_status_code: int = 403) -> Tuple[bool, int, str, bool]:
+        """按 PROBE_METHOD 选择探测方式，返回值与 test_ip_status 相同"""
+        if PROBE_METHOD == 'raw':
+            return self.test_ip_status_raw(ip_address, test_url_template, expected_status_code)
+        return self.test_ip_status(ip_address, test_url_template, expected_status_code)
+    
+    def test_ip_status_raw(self, ip_address: str, test_url_template: str, expected_status_code: int = 403) -> Tuple[bool, int, str, bool]:
+        """基于原始套接字的精简探测：发送最小的 HTTP/1.1 请求，只解析状态行后立即关闭连接
+        
+        不经过 requests/urllib3，没有连接池记账和响应头、响应体处理，整个探测受 REQUEST_TIMEOUT 总时限约束。
+        """
+        start = time.perf_counter()
+        sock = None
+        try:
+            host, port, tls_hostname, request, is_ipv6 = self.build_probe_target(ip_address, test_url_template)
+            deadline = Deadline(REQUEST_TIMEOUT)
+            
+            sock = socket.create_connection((host, port), timeout=deadline.remaining())
+            if tls_hostname:
+                sock.settimeout(deadline.remaining())
+                sock = self.probe_ssl_context().wrap_socket(sock, server_hostname=tls_hostname)
+            sock.settimeout(deadline.remaining())
+            sock.sendall(request)
+            
+            buffer = b''
+            while b'\r\n' not in buffer and len(buffer) < 8192:
+                sock.settimeout(deadline.remaining())
+                data = sock.recv(1024)
+                if not data:
+                    break
+                buffer += data
+            
+            status_code, reason = self.parse_status_line(buffer.split(b'\r\n', 1)[0])
+            self.probe_latency[ip_address] = (time.perf_counter() - start) * 1000
+            logger.debug(f"测试 IP {ip_address}: 状态码 {status_code}")
+            return status_code == expected_status_code, status_code, reason, is_ipv6
+        except socket.timeout:
+            logger.debug(f"测试 IP {ip_address}: 请求超时")
+            return False, 0, "Timeout", ':' in ip_address
+        except (OSError, ssl.SSLError):
+            logger.debug(f"测试 IP {ip_address}: 连接错误")
+            return False, 0, "Connection Error", ':' in ip_address
+        except Exception as e:
+            logger.debug(f"测试 IP {ip_address} 时发生异常: {str(e)}")
+            return False, 0, str(e), ':' in ip_address
+        finally:
+            if sock is not None:
+                sock.close()
+            METRICS.observe('probe_latency_ms', (time.perf_counter() - start) * 1000)
+    
+    @classmethod
+    def probe_ssl_context(cls) -> ssl.SSLContext:
+        """探测共用的TLS上下文，避免每次探测都重新加载CA证书"""
+        if cls._ssl_context is None:
+            cls._ssl_context = ssl.create_default_context()
+        return cls._ssl_context
+    
+    @staticmethod
+    def build_probe_target(ip_address: str, test_url_template: str) -> Tuple[str, int, Optional[str], bytes, bool]:
+        """根据URL模板构建原始HTTP探测目标，返回 (连接地址, 端口, TLS主机名, 请求报文, 是否IPv6)
+        
+        配置了 PROBE_HOST 时用它作为 Host 头，否则使用URL中的主机部分。
+        """
+        try:
+            is_ipv6 = ipaddress.ip_address(ip_address).version == 6
+        except ValueError:
+            is_ipv6 = ':' in ip_address
+        
+        test_url = test_url_template.format(ip=f"[{ip_address}]" if is_ipv6 else ip_address)
+        return (*build_get_request(test_url, host=PROBE_HOST), is_ipv6)
+    
+    @staticmethod
+    def parse_status_line(status_line: bytes) -> Tuple[int, str]:
+        """解析HTTP状态行，返回 (状态码, 原因短语)"""
+        parts = status_line.decode('latin-1').strip().split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdigit():
+            raise ValueError(f"无效的HTTP状态行: {status_line[:64]!r}")
+        return int(parts[1]), parts[2] if len(parts) > 2 else ''
+    
+    async def _async_test_ip_status(self, ip_address: str, test_url_template: str, expected_status_code: int,
+                                    ssl_context: Optional[ssl.SSLContext] = None) -> Tuple[str, bool, int, str, bool]:
+        """基于非阻塞套接字的单IP状态码探测，只读取状态行；HTTPS探测使用调用方传入的共享TLS上下文"""
+        try:
+            host, port, tls_hostname, request, is_ipv6 = self.build_probe_target(ip_address, test_url_template)
+        except Exception as e:
+            logger.debug(f"测试 IP {ip_address} 时发生异常: {str(e)}")
+            return ip_address, False, 0, str(e), False
+        
+        start = time.perf_counter()
+        writer = None
+        
+        async def probe() -> bytes:
+            nonlocal writer
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=(ssl_context or self.probe_ssl_context()) if tls_hostname else None,
+                server_hostname=tls_hostname
+            )
+            writer.write(request)
+            await writer.drain()
+            return await reader.readline()
+        
+        try:
+            status_line = await asyncio.wait_for(probe(), timeout=REQUEST_TIMEOUT)
+            status_code, reason = self.parse_status_line(status_line)
+            self.probe_latency[ip_address] = (time.perf_counter() - start) * 1000
+            logger.debug(f"测试 IP {ip_address}: 状态码 {status_code}")
+            return ip_address, status_code == expected_status_code, status_code, reason, is_ipv6
+        except asyncio.TimeoutError:
+            logger.debug(f"测试 IP {ip_address}: 请求超时")
+            return ip_address, False, 0, "Timeout", is_ipv6
+        except (OSError, ssl.SSLError):
+            logger.debug(f"测试 IP {ip_address}: 连接错误")
+            return ip_address, False, 0, "Connection Error", is_ipv6
+        except Exception as e:
+            logger.debug(f"测试 IP {ip_address} 时发生异常: {str(e)}")
+            return ip_address, False, 0, str(e), is_ipv6
+        finally:
+            METRICS.observe('probe_latency_ms', (time.perf_counter() - start) * 1000)
+            if writer is not None:
+                writer.close()
+    
+    async def _async_probe_batch(self, ip_addresses: List[str], test_url_template: str, expected_status_code: int,
+                                 stop_after: Optional[int] = None) -> List[Tuple[str, bool, int, str, bool]]:
+        """以信号量限制并发数，异步探测一批IP
+        
+        合格数量达到 stop_after 后不再发起新的探测；已在途的探测在宽限时间内完成的结果照常返回（见 drain_grace）。
+        """
+        semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+        # 创建TLS上下文需要加载CA证书（数十毫秒，且会阻塞事件循环），整批探测共用一个
+        ssl_context = self.probe_ssl_context() if urlsplit(test_url_template).scheme == 'https' else None
+        stopping = False
+        
+        async def run(ip: str) -> Optional[Tuple[str, bool, int, str, bool]]:
+            async with semaphore:
+                if stopping:
+                    return None
+                return await self._async_test_ip_status(ip, test_url_template, expected_status_code, ssl_context)
+        
+        tasks = [asyncio.ensure_future(run(ip)) for ip in ip_addresses]
         results = []
+        qualified = []
         
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            future_to_ip = {
-                executor.submit(self.test_ip_status, ip, test_url_template, expected_status_code): ip 
-                for ip in ip_addresses
-            }
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                results.append(result)
+                if result[1]:
+                    qualified.append(result[0])
+                    if stop_after is not None and len(qualified) >= stop_after:
+                        break
             
-            for future in as_completed(future_to_ip):
-                ip = future_to_ip[future]
-                try:
-                    success, status_code, reason, is_ipv6 = future.result()
-                    results.append((ip, success))
-                except Exception as e:
-                    print(f"测试IP {ip} 时发生异常: {e}")
-                    results.append((ip, False))
+            if stop_after is not None and len(qualified) >= stop_after:
+                stopping = True
+                unfinished = [task for task in tasks if not task.done()]
+                if unfinished:
+                    await asyncio.wait(unfinished, timeout=self.drain_grace(qualified))
+                seen = {result[0] for result in results}
+                results.extend(
+                    task.result() for task in tasks
+                    if task.done() and not task.cancelled() and task.result() is not None
+                    and task.result()[0] not in seen
+                )
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
         
         return results
     
-    def generate_and_test_ips(self, num_ips: int = 3, is_ipv6: bool = False) -> List[str]:
-        """生成并测试IP地址，确保返回指定状态码"""
-        cidr_type = "IPv6" if is_ipv6 else "IPv4"
-        print(f"正在生成并测试 {num_ips} 个{cidr_type}地址...")
+    def test_multiple_ips_async(self, ip_addresses: List[str], test_url_template: str, expected_status_code: int = 403) -> List[Tuple[str, bool, int, str, bool]]:
+        """使用asyncio引擎并发测试多个IP地址，返回 (ip, 是否合格, 状态码, 原因, 是否IPv6)"""
+        raise_fd_limit()
+        return asyncio.run(self._async_probe_batch(list(ip_addresses), test_url_template, expected_status_code))
+    
+    def test_multiple_ips_concurrently(self, ip_addresses: List[str], test_url_template: str, expected_status_code: int = 403) -> List[Tuple[str, bool]]:
+        """并发测试多个IP地址"""
+        return [
+            (ip, success)
+            for ip, success, status_code, reason, is_ipv6 in self.probe_ips_stream(ip_addresses, test_url_template, expected_status_code)
+        ]
+    
+    def probe_ips_stream(self, ip_addresses: Iterable[str], test_url_template: str, expected_status_code: int = 403,
+                         stop_after: Optional[int] = None) -> Iterator[Tuple[str, bool, int, str, bool]]:
+        """按 PROBE_ENGINE 选择探测引擎，逐个返回 (ip, 是否合格, 状态码, 原因, 是否IPv6)"""
+        if PROBE_ENGINE == 'asyncio':
+            stream = self._async_probe_stream(ip_addresses, test_url_template, expected_status_code, stop_after)
+        else:
+            stream = self._thread_probe_stream(ip_addresses, test_url_template, expected_status_code, stop_after)
+        return self._count_outcomes(stream)
+    
+    @staticmethod
+    def _count_outcomes(stream: Iterator[Tuple[str, bool, int, str, bool]]) -> Iterator[Tuple[str, bool, int, str, bool]]:
+        """透传探测结果，同时按原因计数"""
+        try:
+            for result in stream:
+                METRICS.inc('probe_outcomes', probe_outcome(result[1], result[2], result[3]), label_name='reason')
+                yield result
+        finally:
+            stream.close()
+    
+    def _async_probe_stream(self, ip_addresses: Iterable[str], test_url_template: str, expected_status_code: int = 403,
+                            stop_after: Optional[int] = None) -> Iterator[Tuple[str, bool, int, str, bool]]:
+        """asyncio引擎：按批取出候选IP，每批在一个事件循环中以数千并发探测"""
+        raise_fd_limit()
+        candidates = iter(ip_addresses)
+        batch_size = max(ASYNC_CONCURRENCY * 4, 1)
+        passed = 0
+        
+        while stop_after is None or passed < stop_after:
+            batch = list(islice(candidates, batch_size))
+            if not batch:
+                break
+            
+            remaining = None if stop_after is None else stop_after - passed
+            for result in asyncio.run(self._async_probe_batch(batch, test_url_template, expected_status_code, remaining)):
+                if result[1]:
+                    passed += 1
+                yield result
+    
+    def _thread_probe_stream(self, ip_addresses: Iterable[str], test_url_template: str, expected_status_code: int = 403,
+                             stop_after: Optional[int] = None) -> Iterator[Tuple[str, bool, int, str, bool]]:
+        """线程池引擎：通过有界线程池并发探测IP，按完成顺序逐个返回结果
+        
+        同时在途的探测数不超过 MAX_WORKERS，候选IP按需从迭代器中取出；合格数量达到 stop_after 后
+        不再发起新的探测，已在途的探测在宽限时间内完成的结果照常返回（见 drain_grace），其余取消。
+        """
+        candidates = iter(ip_addresses)
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        pending = {}
+        qualified = []
+        
+        def outcome(future, ip: str) -> Tuple[str, bool, int, str, bool]:
+            try:
+                success, status_code, reason, is_ipv6 = future.result()
+            except Exception as e:
+                logger.debug(f"测试IP {ip} 时发生异常: {e}")
+                success, status_code, reason, is_ipv6 = False, 0, str(e), ':' in ip
+            return ip, success, status_code, reason, is_ipv6
+        
+        try:
+            while True:
+                # 补齐探测窗口
+                while len(pending) < MAX_WORKERS:
+                    ip = next(candidates, None)
+                    if ip is None:
+                        break
+                    future = executor.submit(self.probe_ip_status, ip, test_url_template, expected_status_code)
+                    pending[future] = ip
+                
+                if not pending:
+                    break
+                
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = outcome(future, pending.pop(future))
+                    if result[1]:
+                        qualified.append(result[0])
+                    yield result
+                
+                if stop_after is not None and len(qualified) >= stop_after:
+                    if pending:
+                        done, _ = wait(pending, timeout=self.drain_grace(qualified))
+                        for future in done:
+                            yield outcome(future, pending.pop(future))
+                    break
+        finally:
+            # 取消尚未开始的探测，已在进行中的请求最多再占用一个超时周期
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+    
+    def drain_grace(self, qualified: List[str]) -> float:
+        """达到 stop_after 后等待在途探测的时间（秒）：已合格IP中最慢的探测耗时
         
-        ipv4_cidrs, ipv6_cidrs = self.get_cloudflare_ips()
-        cidrs = ipv6_cidrs if is_ipv6 else ipv4_cidrs
+        在此之后才完成的探测比所有已合格IP都慢，不可能进入排名前列，没有必要再等。
+        """
+        return max((self.probe_latency.get(ip, 0.0) for ip in qualified), default=0.0) / 1000
+    
+    @staticmethod
+    def measure_tcp_latency(ip_addresses: Iterable[str], port: int, timeout: float = TCP_CONNECT_TIMEOUT,
+                            concurrency: int = TCP_CONNECT_CONCURRENCY) -> Dict[str, Optional[float]]:
+        """使用非阻塞套接字批量测量TCP握手耗时（毫秒），连接失败或超时记为 None"""
+        raise_fd_limit()
+        candidates = iter(ip_addresses)
+        selector = selectors.DefaultSelector()
+        in_flight = deque()  # (截止时间, 套接字)，超时时间相同，因此截止时间单调递增
+        latency = {}
         
-        if not cidrs:
-            print(f"无法获取{cidr_type}地址范围")
+        def start_next() -> bool:
+            ip = next(candidates, None)
+            if ip is None:
+                return False
+            sock = socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            started = time.perf_counter()
+            try:
+                code = sock.connect_ex((ip, port))
+            except OSError:
+                code = errno.EHOSTUNREACH
+            if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                latency[ip] = None
+                sock.close()
+                return True
+            selector.register(sock, selectors.EVENT_WRITE, (ip, started))
+            in_flight.append((started + timeout, sock))
+            return True
+        
+        def collect(wait_time: float):
+            for key, _ in selector.select(timeout=wait_time):
+                ip, started = key.data
+                sock = key.fileobj
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                latency[ip] = (time.perf_counter() - started) * 1000 if error == 0 else None
+                selector.unregister(sock)
+                sock.close()
+        
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(selector.get_map()) < concurrency:
+                    exhausted = not start_next()
+                    # 每发起一个连接就检查一次已完成的握手，避免把发起后续连接的时间计入前面连接的延迟
+                    collect(0)
+                if not selector.get_map():
+                    break
+                
+                wait_time = max(in_flight[0][0] - time.perf_counter(), 0) if in_flight else timeout
+                collect(min(wait_time, 0.05))
+                
+                # 清理超时的连接
+                now = time.perf_counter()
+                while in_flight and (in_flight[0][0] <= now or in_flight[0][1].fileno() == -1):
+                    _, sock = in_flight.popleft()
+                    if sock.fileno() != -1:
+                        latency[selector.get_key(sock).data[0]] = None
+                        selector.unregister(sock)
+                        sock.close()
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+        
+        return latency
+    
+    def tcp_prefilter(self, ip_addresses: List[str], keep: int) -> List[str]:
+        """TCP握手预筛选：返回握手最快的 keep 个IP（按延迟升序），并记录其延迟"""
+        port = TCP_PREFILTER_PORT or self.build_probe_target('0.0.0.0', TEST_URL_TEMPLATE)[1]
+        started = time.time()
+        latency = self.measure_tcp_latency(ip_addresses, port)
+        reachable = sorted((rtt, ip) for ip, rtt in latency.items() if rtt is not None)
+        survivors = [ip for rtt, ip in reachable[:keep]]
+        self.tcp_latency.update((ip, rtt) for rtt, ip in reachable)
+        
+        elapsed = max(time.time() - started, 1e-6)
+        print(f"TCP预筛选: {len(ip_addresses)} 个候选中 {len(reachable)} 个可连接，保留最快的 {len(survivors)} 个"
+              f"（端口 {port}，耗时 {elapsed:.2f}秒，速率 {len(ip_addresses) / elapsed:.1f} 个/秒）")
+        return survivors
+    
+    @METRICS.timed('score')
+    def score_ips(self, ip_addresses: List[str], top_k: int, samples: int = PROBE_SAMPLES) -> List[Dict]:
+        """按中位延迟、抖动和丢包综合打分
+        
+        samples 为 0 时不发起额外连接，直接使用状态码探测测得的首字节耗时（单个样本，没有抖动和丢包）；
+        大于 0 时对每个IP额外做 samples 次TCP握手计时采样。
+        分数 = 中位延迟 + JITTER_WEIGHT × 抖动 + 丢包率 × LOSS_PENALTY_MS，越低越好；
+        使用容量为 top_k 的堆保留最优结果，按分数升序返回。
+        """
+        if not ip_addresses or top_k <= 0:
             return []
         
-        qualified_ips = []
-        attempted_ips = set()
-        total_attempts = 0
-        max_total_attempts = num_ips * 15
+        if samples > 0:
+            port = TCP_PREFILTER_PORT or self.build_probe_target('0.0.0.0', TEST_URL_TEMPLATE)[1]
+            rtt_samples = {ip: [] for ip in ip_addresses}
+            for _ in range(samples):
+                for ip, rtt in self.measure_tcp_latency(ip_addresses, port).items():
+                    rtt_samples[ip].append(rtt)
+        else:
+            rtt_samples = {ip: [self.probe_latency[ip]] if ip in self.probe_latency else [] for ip in ip_addresses}
         
-        while len(qualified_ips) < num_ips and total_attempts < max_total_attempts:
-            # 随机选择一个CIDR范围
-            random_cidr = random.choice(cidrs)
+        heap = []
+        for ip, rtts in rtt_samples.items():
+            ok = [rtt for rtt in rtts if rtt is not None]
+            loss = 1 - len(ok) / len(rtts) if rtts else 1.0
+            if ok:
+                median_rtt = statistics.median(ok)
+                jitter = statistics.mean(abs(a - b) for a, b in zip(ok, ok[1:])) if len(ok) > 1 else 0.0
+                score = median_rtt + JITTER_WEIGHT * jitter + loss * LOSS_PENALTY_MS
+            else:
+                median_rtt, jitter, score = None, None, float('inf')
             
-            # 从该范围生成随机IP
-            random_ip = self.generate_random_ip_from_cidr(random_cidr, is_ipv6)
+            self.ip_scores[ip] = {'ip': ip, 'rtt': median_rtt, 'jitter': jitter, 'loss': loss, 'score': score}
             
-            if not random_ip:
-                total_attempts += 1
-                continue
+            if len(heap) < top_k:
+                heapq.heappush(heap, (-score, ip))
+            else:
+                heapq.heappushpop(heap, (-score, ip))
+        
+        return [self.ip_scores[ip] for _, ip in sorted(heap, reverse=True)]
+    
+    @staticmethod
+    def measure_download_speed(ip_address: str, test_url: str = SPEED_TEST_URL, max_seconds: float = SPEED_TEST_MAX_SECONDS,
+                               max_bytes: int = SPEED_TEST_MAX_BYTES) -> Tuple[float, int]:
+        """经指定IP下载测速文件，返回 (吞吐量Mbps, 下载字节数)
+        
+        直接连接该IP，Host头与TLS SNI使用测速URL中的域名；数据读入固定大小的缓冲区后丢弃，
+        内存占用恒定。达到时间上限或字节上限即停止。
+        """
+        _, port, tls_hostname, request = build_get_request(test_url)
+        
+        buffer = bytearray(64 * 1024)
+        view = memoryview(buffer)
+        sock = socket.create_connection((ip_address, port), timeout=REQUEST_TIMEOUT)
+        try:
+            if tls_hostname:
+                sock = CloudflareIPManager.probe_ssl_context().wrap_socket(sock, server_hostname=tls_hostname)
+            sock.sendall(request)
             
-            # 检查是否已经尝试过这个IP
-            if random_ip in attempted_ips:
-                total_attempts += 1
-                continue
+            # 读取响应头，只保留头部所在的少量数据
+            header = b''
+            while b'\r\n\r\n' not in header:
+                received = sock.recv_into(buffer)
+                if not received:
+                    raise ConnectionError("响应头未完整返回")
+                header += bytes(view[:received])
+                if len(header) > 65536:
+                    raise ValueError("响应头过大")
+            head, _, body_start = header.partition(b'\r\n\r\n')
+            status_code, reason = CloudflareIPManager.parse_status_line(head.split(b'\r\n', 1)[0])
+            if status_code != 200:
+                raise ValueError(f"测速请求返回状态码 {status_code} {reason}")
             
-            # 测试IP
-            is_qualified, status_code, reason, detected_ipv6 = self.test_ip_status(
-                random_ip, 
-                TEST_URL_TEMPLATE, 
-                EXPECTED_STATUS_CODE
-            )
+            total = len(body_start)
+            started = time.perf_counter()
+            deadline = started + max_seconds
+            while total < max_bytes:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                sock.settimeout(min(remaining, REQUEST_TIMEOUT))
+                try:
+                    received = sock.recv_into(view[:min(len(buffer), max_bytes - total)])
+                except socket.timeout:
+                    break
+                if not received:
+                    break
+                total += received
+            elapsed = max(time.perf_counter() - started, 1e-6)
+        finally:
+            sock.close()
+        
+        return total * 8 / elapsed / 1_000_000, total
+    
+    @METRICS.timed('speed_test')
+    def speed_test_ips(self, ranked: List[Dict]) -> List[Dict]:
+        """对入围IP逐个测速（串行，避免互相争抢带宽），并按吞吐量重新排序"""
+        print(f"开始下载测速: {len(ranked)} 个入围IP，测速地址 {SPEED_TEST_URL}")
+        for entry in ranked:
+            ip = entry['ip']
+            try:
+                speed, total = self.measure_download_speed(ip, SPEED_TEST_URL, SPEED_TEST_MAX_SECONDS, SPEED_TEST_MAX_BYTES)
+                print(f"测速 IP {ip}: {speed:.2f} Mbps（下载 {total / 1024 / 1024:.2f} MB）")
+            except Exception as e:
+                speed = 0.0
+                print(f"测速 IP {ip} 失败: {e}")
+            entry['speed'] = speed
+        
+        # 吞吐量优先，吞吐量相同时按延迟评分
+        return sorted(ranked, key=lambda entry: (-entry['speed'], entry['score']))
+    
+    @staticmethod
+    def trace_ip(ip_address: str, trace_url: str = TRACE_URL, sni: str = TRACE_SNI) -> Dict:
+        """经指定IP请求 /cdn-cgi/trace，分别记录TCP握手、TLS握手和首字节耗时（毫秒），并解析 colo/loc
+        
+        SNI 与 Host 头使用 sni（留空时取URL中的域名），证书按该域名校验；整个请求受 REQUEST_TIMEOUT 总时限约束。
+        """
+        _, port, tls_hostname, request = build_get_request(trace_url, host=sni, sni=sni)
+        result = {'ip': ip_address, 'tcp_ms': None, 'tls_ms': None, 'ttfb_ms': None,
+                  'status': 0, 'colo': None, 'loc': None, 'error': None}
+        deadline = Deadline(REQUEST_TIMEOUT)
+        sock = None
+        try:
+            start = time.perf_counter()
+            sock = socket.create_connection((ip_address, port), timeout=deadline.remaining())
+            connected = time.perf_counter()
+            result['tcp_ms'] = (connected - start) * 1000
+            if tls_hostname:
+                sock.settimeout(deadline.remaining())
+                sock = CloudflareIPManager.probe_ssl_context().wrap_socket(sock, server_hostname=tls_hostname)
+                result['tls_ms'] = (time.perf_counter() - connected) * 1000
+            
+            sock.settimeout(deadline.remaining())
+            sent = time.perf_counter()
+            sock.sendall(request)
+            response = b''
+            while len(response) < 65536:
+                sock.settimeout(deadline.remaining())
+                data = sock.recv(4096)
+                if not data:
+                    break
+                if not response:
+                    result['ttfb_ms'] = (time.perf_counter() - sent) * 1000
+                response += data
+            
+            head, _, body = response.partition(b'\r\n\r\n')
+            result['status'] = CloudflareIPManager.parse_status_line(head.split(b'\r\n', 1)[0])[0]
+            # trace 响应体为每行一个 key=value；分块编码时的长度行不含 '='，会被忽略
+            fields = dict(line.split('=', 1) for line in body.decode('latin-1').splitlines() if '=' in line)
+            result['colo'] = fields.get('colo', '').strip().upper() or None
+            result['loc'] = fields.get('loc', '').strip().upper() or None
+        except socket.timeout:
+            result['error'] = "Timeout"
+        except (OSError, ssl.SSLError) as e:
+            result['error'] = f"Connection Error: {e}"
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            if sock is not None:
+                sock.close()
+        return result
+    
+    @METRICS.timed('trace')
+    def trace_ips(self, ip_addresses: List[str]) -> Dict[str, Dict]:
+        """并发对一批IP做HTTPS探测，结果保存在 ip_traces 中"""
+        traces = {}
+        with ThreadPoolExecutor(max_workers=max(min(MAX_WORKERS, len(ip_addresses)), 1)) as executor:
+            for trace in executor.map(self.trace_ip, ip_addresses):
+                traces[trace['ip']] = trace
+                if trace['tcp_ms'] is not None:
+                    METRICS.observe('tcp_connect_ms', trace['tcp_ms'])
+                if trace['tls_ms'] is not None:
+                    METRICS.observe('tls_handshake_ms', trace['tls_ms'])
+                METRICS.inc('trace_colos', trace['colo'] or 'unknown', label_name='colo')
+                if trace['error']:
+                    logger.debug(f"HTTPS探测 IP {trace['ip']} 失败: {trace['error']}")
+                else:
+                    logger.debug(f"HTTPS探测 IP {trace['ip']}: 数据中心 {trace['colo']} ({trace['loc']}), "
+                                 f"TCP {trace['tcp_ms']:.1f}ms, TLS {trace['tls_ms'] or 0:.1f}ms")
+        self.ip_traces.update(traces)
+        return traces
+    
+    def filter_by_colo(self, ip_addresses: List[str], cidr_type: str) -> List[str]:
+        """对合格IP做HTTPS探测并按数据中心分组输出，丢弃探测失败和位于 EXCLUDED_COLOS 的IP"""
+        traces = self.trace_ips(ip_addresses)
+        groups: Dict[str, List[Dict]] = {}
+        for ip in ip_addresses:
+            trace = traces[ip]
+            if trace['error'] is None and trace['status'] == 200 and trace['colo']:
+                groups.setdefault(trace['colo'], []).append(trace)
+        
+        print(f"{cidr_type}合格IP按数据中心分组（{TRACE_URL}）:")
+        for colo, members in sorted(groups.items(), key=lambda item: (self.colo_rank(item[0]), -len(item[1]))):
+            tls = [trace['tls_ms'] for trace in members if trace['tls_ms'] is not None]
+            tcp = statistics.median(trace['tcp_ms'] for trace in members)
+            mark = " [排除]" if colo in EXCLUDED_COLOS else " [优先]" if colo in PREFERRED_COLOS else ""
+            print(f"  {colo} ({members[0]['loc'] or '?'}): {len(members)} 个IP, TCP中位 {tcp:.1f}ms"
+                  + (f", TLS中位 {statistics.median(tls):.1f}ms" if tls else "") + mark)
+        METRICS.set_info(f'colos_{cidr_type.lower()}', {colo: len(members) for colo, members in groups.items()})
+        
+        kept = [ip for ip in ip_addresses
+                if traces[ip]['colo'] in groups and traces[ip]['colo'] not in EXCLUDED_COLOS]
+        if len(kept) < len(ip_addresses):
+            print(f"丢弃 {len(ip_addresses) - len(kept)} 个HTTPS探测失败或位于排除数据中心的{cidr_type} IP")
+        return kept
+    
+    def colo_rank(self, colo: Optional[str]) -> int:
+        """数据中心在 PREFERRED_COLOS 中的位置，越小越优先；未列出的排在最后"""
+        return PREFERRED_COLOS.index(colo) if colo in PREFERRED_COLOS else len(PREFERRED_COLOS)
+    
+    def rank_by_colo(self, ranked: List[Dict]) -> List[Dict]:
+        """按 PREFERRED_COLOS 顺序把优先数据中心的IP排在前面，同一数据中心内保持原有排名"""
+        return sorted(ranked, key=lambda entry: self.colo_rank((self.ip_traces.get(entry['ip']) or {}).get('colo')))
+    
+    def describe_ip(self, ip_address: str) -> str:
+        """返回IP及其质量评分的可读描述"""
+        score = self.ip_scores.get(ip_address)
+        if not score or score['rtt'] is None:
+            return ip_address
+        speed = f", 带宽 {score['speed']:.2f}Mbps" if 'speed' in score else ""
+        trace = self.ip_traces.get(ip_address) or {}
+        if trace.get('colo'):
+            tls = f", TLS握手 {trace['tls_ms']:.1f}ms" if trace.get('tls_ms') is not None else ""
+            speed += f", 数据中心 {trace['colo']}{tls}"
+        return (f"{ip_address} (延迟 {score['rtt']:.1f}ms, 抖动 {score['jitter']:.1f}ms, "
+                f"丢包 {score['loss']:.0%}{speed})")
+    
+    def get_sampler(self, cidrs: List[str], is_ipv6: bool) -> CIDRSampler:
+        """获取（或构建）对应地址族的分层采样器，地址范围不变时在整个运行期间复用"""
+        key = tuple(cidrs)
+        cached = self.samplers.get(is_ipv6)
+        if cached and cached[0] == key:
+            return cached[1]
+        
+        sampler = CIDRSampler(cidrs, is_ipv6)
+        self.samplers[is_ipv6] = (key, sampler)
+        self.bandits[is_ipv6] = SubnetBandit(sampler)
+        self.vector_generators.pop(is_ipv6, None)
+        print(f"构建{'IPv6' if is_ipv6 else 'IPv4'}采样索引: {len(sampler.starts)} 个合并后网段，"
+              f"{sampler.total_strata} 个 /{sampler.stratum_prefix} 分层，共 {sampler.total_addresses} 个地址")
+        return sampler
+    
+    @METRICS.timed('generate')
+    def generate_candidate_batch(self, cidrs: List[str], batch_size: int, is_ipv6: bool, attempted_ips: set) -> Tuple[List[str], int]:
+        """从CIDR列表中分层无放回地生成一批未尝试过的IP，返回 (候选IP列表, 消耗的尝试次数)
+        
+        SEARCH_STRATEGY=bandit 时由 SubnetBandit 决定从哪个分层抽取；
+        SEARCH_STRATEGY=vectorized 时由 VectorizedIPGenerator 成块生成（需要numpy）。
+        """
+        sampler = self.get_sampler(cidrs, is_ipv6)
+        if SEARCH_STRATEGY == 'bandit':
+            draw = self.bandits[is_ipv6].choose
+        elif SEARCH_STRATEGY == 'vectorized' and np is not None:
+            if is_ipv6 not in self.vector_generators:
+                self.vector_generators[is_ipv6] = VectorizedIPGenerator(cidrs, is_ipv6)
+            draw = self.vector_generators[is_ipv6].draw
+        else:
+            draw = sampler.draw
+        batch = []
+        attempts = 0
+        
+        while len(batch) < batch_size and attempts < batch_size * 3:
+            attempts += 1
+            random_ip = draw()
+            
+            # 跳过无效或已经尝试过的IP（例如本次已复测过的历史IP）
+            if not random_ip or random_ip in attempted_ips:
+                continue
             
             attempted_ips.add(random_ip)
-            total_attempts += 1
+            batch.append(random_ip)
+        
+        return batch, attempts
+    
+    @staticmethod
+    def load_ranked_ips(path: str, num_ips: int, is_ipv6: bool = False) -> List[str]:
+        """从全量扫描生成的排名表中读取排名最靠前的合格IP"""
+        selected = []
+        try:
+            with open(path, 'r', encoding='utf-8', newline='') as file:
+                for row in csv.DictReader(file):
+                    if len(selected) >= num_ips:
+                        break
+                    if row.get('success') == '1' and (':' in row['ip']) == is_ipv6:
+                        selected.append(row['ip'])
+        except OSError as e:
+            print(f"读取排名表 {path} 失败: {e}")
+        print(f"从排名表 {path} 中选取 {len(selected)} 个{'IPv6' if is_ipv6 else 'IPv4'}地址")
+        return selected
+    
+    @METRICS.timed('search')
+    def generate_and_test_ips(self, num_ips: int = 3, is_ipv6: bool = False) -> List[str]:
+        """生成并测试IP地址，确保返回指定状态码，并按延迟/抖动/丢包评分返回最优的 num_ips 个"""
+        cidr_type = "IPv6" if is_ipv6 else "IPv4"
+        print(f"正在生成并测试 {num_ips} 个{cidr_type}地址...")
+        
+        qualified_ips = []
+        pool_size = num_ips * max(RANK_POOL_FACTOR, 1)
+        attempted_ips = set()
+        max_total_attempts = num_ips * 15
+        counters = {'attempts': 0, 'probed': 0}
+        probe_results = []
+        
+        def consume(stream: Iterator[Tuple[str, bool, int, str, bool]]):
+            try:
+                for ip, is_qualified, status_code, reason, detected_ipv6 in stream:
+                    counters['probed'] += 1
+                    probe_results.append((ip, is_qualified))
+                    if is_ipv6 in self.bandits:
+                        self.bandits[is_ipv6].update(ip, is_qualified, self.probe_latency.get(ip))
+                    if is_qualified:
+                        # 达到 pool_size 时仍在途的探测也可能合格，一并保留参与评分，不额外消耗探测次数
+                        qualified_ips.append(ip)
+                        logger.info(f"✓ 找到合格{cidr_type} IP {len(qualified_ips)}/{pool_size}: {ip}")
+                    elif not is_qualified:
+                        logger.debug(f"✗ {cidr_type} IP不合格: {ip} (状态码: {status_code})")
+            finally:
+                stream.close()
+        
+        start_time = time.time()
+        
+        # 第一阶段: 优先复测历史上表现良好的IP，其次是采集到的候选IP
+        known_good = self.history.known_good(is_ipv6, pool_size * 2) if self.history else []
+        if known_good:
+            print(f"优先复测 {len(known_good)} 个历史优质{cidr_type} IP")
+        known_set = set(known_good)
+        seeds = [ip for ip in self.load_seed_ips(is_ipv6, pool_size * 2) if ip not in known_set]
+        preferred = known_good + seeds
+        if preferred:
+            attempted_ips.update(preferred)
+            counters['attempts'] += len(preferred)
+            consume(self.probe_ips_stream(preferred, TEST_URL_TEMPLATE, EXPECTED_STATUS_CODE, stop_after=pool_size))
+        
+        # 第二阶段: 历史IP和候选IP不足时，才获取地址范围并探索新的地址空间
+        if len(qualified_ips) < pool_size:
+            ipv4_cidrs, ipv6_cidrs = self.get_cloudflare_ips()
+            cidrs = ipv6_cidrs if is_ipv6 else ipv4_cidrs
             
-            if is_qualified:
-                qualified_ips.append(random_ip)
-                print(f"✓ 找到合格{cidr_type} IP {len(qualified_ips)}/{num_ips}: {random_ip}")
+            if not cidrs:
+                print(f"无法获取{cidr_type}地址范围")
             else:
-                print(f"✗ {cidr_type} IP不合格: {random_ip} (状态码: {status_code})")
+                def candidate_batches() -> Iterator[str]:
+                    # 按批生成候选IP，每批大小与并发数一致，直到用完尝试次数
+                    while counters['attempts'] < max_total_attempts:
+                        batch_size = min(MAX_WORKERS, max_total_attempts - counters['attempts'])
+                        if TCP_PREFILTER:
+                            # 先对一大批候选做TCP握手测速，只把最快的一批交给HTTP检测
+                            candidates, _ = self.generate_candidate_batch(cidrs, TCP_PREFILTER_CANDIDATES, is_ipv6, attempted_ips)
+                            batch = self.tcp_prefilter(candidates, batch_size)
+                            if is_ipv6 in self.bandits:
+                                # TCP握手都失败的候选不会进入HTTP检测，直接记为所在分层的一次失败
+                                for ip in candidates:
+                                    if ip not in self.tcp_latency:
+                                        self.bandits[is_ipv6].update(ip, False)
+                            counters['attempts'] += len(batch) or batch_size
+                        else:
+                            batch, attempts = self.generate_candidate_batch(cidrs, batch_size, is_ipv6, attempted_ips)
+                            counters['attempts'] += attempts
+                        for ip in batch:
+                            yield ip
+                
+                consume(self.probe_ips_stream(
+                    candidate_batches(), TEST_URL_TEMPLATE, EXPECTED_STATUS_CODE,
+                    stop_after=pool_size - len(qualified_ips)
+                ))
+        
+        elapsed = max(time.time() - start_time, 1e-6)
+        print(f"{cidr_type}探测完成: 共探测 {counters['probed']} 个候选IP，耗时 {elapsed:.2f}秒，"
+              f"速率 {counters['probed'] / elapsed:.1f} 个/秒")
+        
+        if SEARCH_STRATEGY == 'bandit' and is_ipv6 in self.bandits:
+            stats_file = BANDIT_STATS_FILE.replace('{family}', cidr_type.lower())
+            self.bandits[is_ipv6].dump_stats(path=stats_file)
         
         if len(qualified_ips) < num_ips:
             print(f"警告: 只找到 {len(qualified_ips)} 个合格{cidr_type} IP，目标为 {num_ips} 个")
-            print(f"总尝试次数: {total_attempts}, 尝试过的IP数量: {len(attempted_ips)}")
+            print(f"总尝试次数: {counters['attempts']}, 尝试过的IP数量: {len(attempted_ips)}")
+        
+        # 启用HTTPS探测时，先按数据中心过滤合格IP
+        use_colos = HTTPS_PROBE and bool(qualified_ips)
+        if use_colos:
+            qualified_ips = self.filter_by_colo(qualified_ips, cidr_type)
+        
+        # 对合格IP采样评分，只保留得分最优的 num_ips 个；启用测速时先多保留一些入围IP
+        shortlist_size = max(num_ips, SPEED_TEST_COUNT) if SPEED_TEST else num_ips
+        if use_colos and PREFERRED_COLOS:
+            # 先对全部合格IP评分，优先数据中心的IP排在前面后再截取，避免被其他数据中心挤出入围名单
+            ranked = self.rank_by_colo(self.score_ips(qualified_ips, len(qualified_ips)))[:shortlist_size]
+        else:
+            ranked = self.score_ips(qualified_ips, shortlist_size)
+        if SPEED_TEST and ranked:
+            ranked = self.speed_test_ips(ranked)
+            if use_colos and PREFERRED_COLOS:
+                ranked = self.rank_by_colo(ranked)
+            ranked = ranked[:num_ips]
+        
+        if self.sources and self.seed_sources:
+            # 回写各来源的探测结果，供下次分配预算和跳过低质量来源
+            self.sources.record_probe_results(probe_results, self.seed_sources)
+            self.sources.save_state()
+        
+        if self.history:
+            # 合格IP记录评分得到的中位延迟，其余记录TCP预筛选测得的延迟（如有）
+            self.history.record_results([
+                (ip, success, (self.ip_scores.get(ip) or {}).get('rtt') or self.tcp_latency.get(ip))
+                for ip, success in probe_results
+            ])
+        
+        if ranked:
+            print(f"{cidr_type}评分排名（共 {len(qualified_ips)} 个合格IP）:")
+            for i, entry in enumerate(ranked, 1):
+                print(f"  {i}. {self.describe_ip(entry['ip'])}")
         
-        return qualified_ips
+        return [entry['ip'] for entry in ranked]
+
+class CIDRSweeper:
+    """全量扫描模式：逐个探测CIDR列表中的每一个地址，结果边扫描边写盘
+    
+    地址按块处理：先做TCP握手测速，可连接的地址再做HTTP状态码检测。每块结束后把结果追加到
+    SWEEP_OUTPUT，并原子地写入检查点（已扫描的地址偏移与结果文件长度），中断后可从检查点继续。
+    扫描完成后通过分块排序 + 多路归并生成排名表，内存占用与地址总数无关。
+    """
+    FIELDS = ['ip', 'rtt_ms', 'status', 'success']
+    
+    def __init__(self, ip_manager: 'CloudflareIPManager', cidr_file: str = SWEEP_CIDR_FILE,
+                 output: str = SWEEP_OUTPUT, checkpoint: str = SWEEP_CHECKPOINT):
+        self.ip_manager = ip_manager
+        self.cidr_file = cidr_file
+        self.output = output
+        self.checkpoint = checkpoint
+        
+        with open(cidr_file, 'r', encoding='utf-8') as file:
+            cidrs = [line.strip() for line in file if line.strip()]
+        self.cidr_digest = hashlib.sha1('\n'.join(cidrs).encode('utf-8')).hexdigest()
+        
+        networks = []
+        for cidr in cidrs:
+            try:
+                networks.append(ipaddress.ip_network(cidr, strict=False))
+            except ValueError:
+                print(f"跳过无效的CIDR: {cidr}")
+        # 分别合并IPv4和IPv6网段，去掉重叠部分
+        self.networks = (
+            list(ipaddress.collapse_addresses(n for n in networks if n.version == 4)) +
+            list(ipaddress.collapse_addresses(n for n in networks if n.version == 6))
+        )
+        self.total = sum(network.num_addresses for network in self.networks)
+    
+    def _load_checkpoint(self) -> Tuple[int, int]:
+        """读取检查点，返回 (已扫描的地址数, 结果文件有效长度)；CIDR列表变化时从头开始"""
+        try:
+            with open(self.checkpoint, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            if state.get('cidr_digest') == self.cidr_digest and state.get('output') == self.output:
+                return int(state['offset']), int(state['output_bytes'])
+            print("CIDR列表或输出文件已变化，忽略旧检查点")
+        except (OSError, ValueError, KeyError):
+            pass
+        return 0, 0
+    
+    def _save_checkpoint(self, offset: int, output_bytes: int):
+        state = {
+            'cidr_digest': self.cidr_digest,
+            'output': self.output,
+            'offset': offset,
+            'output_bytes': output_bytes,
+            'total': self.total,
+            'updated_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+        }
+        tmp_path = self.checkpoint + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self.checkpoint)
+    
+    def iter_chunks(self, start: int, chunk_size: int) -> Iterator[Tuple[int, List[str]]]:
+        """从全局偏移 start 开始，按块返回 (块结束后的偏移, 地址列表)"""
+        offset = 0
+        chunk = []
+        for network in self.networks:
+            size = network.num_addresses
+            if offset + size <= start:
+                offset += size
+                continue
+            
+            address_class = ipaddress.IPv6Address if network.version == 6 else ipaddress.IPv4Address
+            base = int(network.network_address)
+            position = max(start - offset, 0)
+            while position < size:
+                take = min(chunk_size - len(chunk), size - position)
+                chunk.extend(str(address_class(base + i)) for i in range(position, position + take))
+                position += take
+                if len(chunk) >= chunk_size:
+                    yield offset + position, chunk
+                    chunk = []
+            offset += size
+        
+        if chunk:
+            yield offset, chunk
+    
+    def probe_chunk(self, ip_addresses: List[str]) -> List[Tuple[str, float, int, bool]]:
+        """TCP握手测速 + HTTP状态码检测，返回可连接地址的 (ip, 延迟, 状态码, 是否合格)"""
+        port = TCP_PREFILTER_PORT or self.ip_manager.build_probe_target('0.0.0.0', TEST_URL_TEMPLATE)[1]
+        latency = self.ip_manager.measure_tcp_latency(ip_addresses, port)
+        reachable = {ip: rtt for ip, rtt in latency.items() if rtt is not None}
+        
+        statuses = {}
+        if SWEEP_HTTP_CHECK and reachable:
+            for ip, success, status_code, reason, is_ipv6 in self.ip_manager.probe_ips_stream(
+                    list(reachable), TEST_URL_TEMPLATE, EXPECTED_STATUS_CODE):
+                statuses[ip] = (status_code, success)
+        
+        return [
+            (ip, rtt, *statuses.get(ip, (0, not SWEEP_HTTP_CHECK)))
+            for ip, rtt in reachable.items()
+        ]
+    
+    @METRICS.timed('sweep')
+    def run(self, chunk_size: int = SWEEP_CHUNK_SIZE) -> int:
+        """执行（或继续）全量扫描，返回本次扫描的地址数"""
+        start, output_bytes = self._load_checkpoint()
+        if start and (not os.path.exists(self.output) or os.path.getsize(self.output) < output_bytes):
+            # 结果文件缺失或被截短，检查点之前的结果已丢失，只能从头扫描
+            print(f"结果文件 {self.output} 缺失或不完整，忽略检查点，从头开始扫描")
+            start, output_bytes = 0, 0
+        if start >= self.total:
+            print(f"扫描已完成（共 {self.total} 个地址），如需重新扫描请删除 {self.checkpoint}")
+            return 0
+        
+        if start:
+            print(f"从检查点继续扫描: 已完成 {start}/{self.total} 个地址")
+        print(f"开始全量扫描: {len(self.networks)} 个合并后网段，共 {self.total} 个地址，每块 {chunk_size} 个")
+        
+        mode = 'r+' if start else 'w'
+        scanned = 0
+        started = time.time()
+        with open(self.output, mode, encoding='utf-8', newline='') as file:
+            if mode == 'r+':
+                # 丢弃检查点之后写入的不完整结果
+                file.seek(output_bytes)
+                file.truncate()
+            writer = csv.writer(file)
+            if not start:
+                writer.writerow(self.FIELDS)
+            
+            for offset, chunk in self.iter_chunks(start, chunk_size):
+                chunk_started = time.time()
+                results = self.probe_chunk(chunk)
+                for ip, rtt, status_code, success in results:
+                    writer.writerow([ip, f"{rtt:.2f}", status_code, int(success)])
+                file.flush()
+                os.fsync(file.fileno())
+                self._save_checkpoint(offset, file.tell())
+                
+                scanned += len(chunk)
+                elapsed = max(time.time() - chunk_started, 1e-6)
+                print(f"扫描进度: {offset}/{self.total} ({offset / self.total:.1%})，本块可连接 {len(results)} 个，"
+                      f"合格 {sum(1 for r in results if r[3])} 个，速率 {len(chunk) / elapsed:.0f} 个/秒")
+        
+        print(f"扫描结束: 本次扫描 {scanned} 个地址，耗时 {time.time() - started:.1f}秒")
+        return scanned
+    
+    @METRICS.timed('sweep_rank')
+    def rank(self, ranked_output: str = SWEEP_RANKED_OUTPUT, sort_chunk: int = SWEEP_SORT_CHUNK) -> int:
+        """外部排序生成排名表：合格优先，其次按延迟升序；返回排名行数"""
+        def sort_key(row: List[str]) -> Tuple[int, float]:
+            return -int(row[3]), float(row[1])
+        
+        chunk_files = []
+        try:
+            with open(self.output, 'r', encoding='utf-8', newline='') as file:
+                reader = csv.reader(file)
+                next(reader, None)
+                while True:
+                    rows = list(islice(reader, sort_chunk))
+                    if not rows:
+                        break
+                    rows.sort(key=sort_key)
+                    chunk_file = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+                    csv.writer(chunk_file).writerows(rows)
+                    chunk_file.seek(0)
+                    chunk_files.append(chunk_file)
+            
+            count = 0
+            with open(ranked_output, 'w', encoding='utf-8', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['rank'] + self.FIELDS)
+                for row in heapq.merge(*(csv.reader(f) for f in chunk_files), key=sort_key):
+                    count += 1
+                    writer.writerow([count] + row)
+        finally:
+            for chunk_file in chunk_files:
+                chunk_file.close()
+        
+        print(f"排名表已保存到 {ranked_output}，共 {count} 条记录")
+        return count
+
+class TokenBucket:
+    """线程安全的令牌桶，用于平滑API请求速率"""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """取得一个令牌，必要时等待"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+    
+    def pause(self, seconds: float):
+        """收到429后清空令牌，让所有线程一起等待 seconds 秒；多个线程同时收到429时等待时间不叠加"""
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+            self.updated = time.monotonic()
 
 class CloudflareDNSManager:
-    def __init__(self):
+    def __init__(self, zone_id: Optional[str] = None, rate_limiter: Optional[TokenBucket] = None):
+        self.zone_id = zone_id or CF_ZONE_ID
         self.headers = {
             'Authorization': f'Bearer {CF_API_TOKEN}',
             'Content-Type': 'application/json'
         }
-        self.base_url = f'https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/dns_records'
+        self.base_url = f'{CF_API_BASE}/zones/{self.zone_id}/dns_records'
+        # 同一API令牌下的多个区域共用一个令牌桶
+        self.rate_limiter = rate_limiter or TokenBucket(API_RATE_LIMIT, API_BURST)
+        self.batch_supported = DNS_BATCH
+        # 复用连接的会话，连接池大小与并发数一致
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=DNS_MAX_WORKERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # 本次运行内的记录缓存: 域名 -> 该域名的全部记录，增删改成功后同步更新
+        self.records_cache: Dict[str, List[Dict]] = {}
+        self.cache_lock = threading.Lock()
     
     def validate_config(self) -> bool:
         """验证必要的配置是否存在"""
-        return bool(CF_API_TOKEN and CF_ZONE_ID and CF_DNS_NAME)
+        return bool(CF_API_TOKEN and self.zone_id)
     
-    def get_dns_records(self, name: str, record_type: str = None) -> List[Dict]:
-        """获取 DNS 记录"""
+    @staticmethod
+    def _is_connect_error(error: requests.RequestException) -> bool:
+        """请求是否在建立连接时就失败（服务器不可能已处理该请求）"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(error, requests.exceptions.ConnectionError) and \
+            isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    
+    def _api_request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """按令牌桶限速发送API请求；遇到429按 Retry-After 等待，遇到5xx或网络错误指数退避重试
+        
+        POST（创建记录、批量接口）不是幂等的，服务器可能已经处理了请求，因此只在连接失败和429时重试。
+        """
+        kwargs.setdefault('timeout', 10)
+        attempts = max(MAX_RETRY_ATTEMPTS, 1)
+        idempotent = method.upper() != 'POST'
+        for attempt in range(attempts):
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                METRICS.observe('api_latency_ms', (time.perf_counter() - start) * 1000)
+                METRICS.inc('api_requests', 'network_error', label_name='status')
+                if attempt == attempts - 1 or not (idempotent or self._is_connect_error(e)):
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            METRICS.observe('api_latency_ms', (time.perf_counter() - start) * 1000)
+            METRICS.inc('api_requests', str(response.status_code), label_name='status')
+            
+            if response.status_code == 429 and attempt < attempts - 1:
+                try:
+                    retry_after = float(response.headers.get('Retry-After', ''))
+                except ValueError:
+                    retry_after = min(2 ** attempt, 30)
+                print(f"API请求被限流，{retry_after:.1f}秒后重试")
+                self.rate_limiter.pause(retry_after)
+                if self.rate_limiter.rate <= 0:
+                    # 未启用限速时令牌桶不会等待，由当前线程自行等待
+                    time.sleep(retry_after)
+                continue
+            if response.status_code >= 500 and idempotent and attempt < attempts - 1:
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            return response
+        return response
+    
+    @staticmethod
+    def _to_record(record: Dict) -> Dict:
+        return {
+            'id': record['id'],
+            'type': record['type'],
+            'content': record.get('content', ''),
+            'name': record['name'],
+            'proxied': record.get('proxied', False)
+        }
+    
+    def get_dns_records(self, name: str, record_type: str = None, use_cache: bool = True) -> List[Dict]:
+        """获取 DNS 记录
+        
+        按域名在服务端过滤并翻页取全所有记录，结果在本次运行内缓存，
+        同一域名的不同记录类型共用一次查询。
+        """
         if not self.validate_config():
             print("缺少必要的环境变量")
             return []
         
+        with self.cache_lock:
+            records = self.records_cache.get(name) if use_cache else None
+        
+        if records is None:
+            records = self._fetch_dns_records(name)
+            if records is None:
+                return []
+            with self.cache_lock:
+                self.records_cache[name] = records
+        
+        with self.cache_lock:
+            return [dict(record) for record in records if record_type is None or record['type'] == record_type]
+    
+    def _fetch_dns_records(self, name: str) -> Optional[List[Dict]]:
+        """分页获取指定域名的全部记录，失败时返回 None"""
+        records = []
+        page = 1
         try:
-            response = requests.get(self.base_url, headers=self.headers, timeout=10)
-            if response.status_code == 200:
-                all_records = response.json()['result']
-                return [
-                    {
-                        'id': record['id'],
-                        'type': record['type'],
-                        'content': record.get('content', ''),
-                        'name': record['name'],
-                        'proxied': record.get('proxied', False)
-                    }
-                    for record in all_records
-                    if record['name'] == name and (record_type is None or record['type'] == record_type)
-                ]
-            else:
-                print(f'获取DNS记录失败: {response.text}')
+            while True:
+                response = self._api_request(
+                    'GET', self.base_url,
+                    params={'name': name, 'page': page, 'per_page': DNS_PAGE_SIZE}
+                )
+                if response.status_code != 200:
+                    print(f'获取DNS记录失败: {response.text}')
+                    return None
+                
+                payload = response.json()
+                records.extend(
+                    self._to_record(record) for record in payload.get('result') or []
+                    if record['name'] == name
+                )
+                total_pages = (payload.get('result_info') or {}).get('total_pages') or 1
+                if page >= total_pages:
+                    break
+                page += 1
         except Exception as e:
             print(f"获取DNS记录失败: {e}")
-        return []
+            return None
+        
+        print(f"获取到 {name} 的 {len(records)} 条DNS记录（{page} 页）")
+        return records
+    
+    def _cache_store(self, record: Dict):
+        """新建或更新成功后写入缓存"""
+        with self.cache_lock:
+            records = self.records_cache.get(record['name'])
+            if records is None:
+                return
+            records[:] = [r for r in records if r['id'] != record['id']] + [self._to_record(record)]
+    
+    def _cache_remove(self, record_id: str):
+        """删除成功后从缓存中移除"""
+        with self.cache_lock:
+            for records in self.records_cache.values():
+                records[:] = [r for r in records if r['id'] != record_id]
     
     def delete_dns_record(self, record_id: str) -> Tuple[bool, str]:
         """删除 DNS 记录"""
@@ -249,11 +1928,12 @@ class CloudflareDNSManager:
         url = f"{self.base_url}/{record_id}"
         
         try:
-            response = requests.delete(url, headers=self.headers, timeout=10)
+            response = self._api_request('DELETE', url)
             
             if response.status_code == 200:
                 result = response.json()
                 if result.get('success'):
+                    self._cache_remove(record_id)
                     log_msg = f"DNS删除成功: 记录ID: {record_id}"
                     print(log_msg)
                     return True, f"记录ID: {record_id} 删除成功"
@@ -271,18 +1951,28 @@ class CloudflareDNSManager:
     
     def create_dns_record(self, name: str, ip_address: str, record_type: str = 'A') -> str:
         """创建 DNS 记录"""
+        return self._write_dns_record(name, ip_address, record_type)[1]
+    
+    def update_dns_record(self, record_id: str, name: str, ip_address: str, record_type: str = 'A') -> Tuple[bool, str]:
+        """原地更新 DNS 记录（PUT），记录ID保持不变"""
+        return self._write_dns_record(name, ip_address, record_type, record_id)
+    
+    def _write_dns_record(self, name: str, ip_address: str, record_type: str = 'A',
+                          record_id: Optional[str] = None) -> Tuple[bool, str]:
+        """创建（record_id 为空时）或更新 DNS 记录，返回 (是否成功, 结果描述)"""
+        action = "更新" if record_id else "创建"
         if not self.validate_config():
-            return "创建失败: 缺少API配置"
+            return False, f"{action}失败: 缺少API配置"
         
         # 检查IP地址类型是否匹配记录类型
         try:
             ip_obj = ipaddress.ip_address(ip_address)
             if record_type == 'A' and ip_obj.version != 4:
-                return f"IP地址 {ip_address} 不是IPv4地址，无法创建A记录"
+                return False, f"IP地址 {ip_address} 不是IPv4地址，无法{action}A记录"
             elif record_type == 'AAAA' and ip_obj.version != 6:
-                return f"IP地址 {ip_address} 不是IPv6地址，无法创建AAAA记录"
+                return False, f"IP地址 {ip_address} 不是IPv6地址，无法{action}AAAA记录"
         except ValueError:
-            return f"IP地址 {ip_address} 格式无效"
+            return False, f"IP地址 {ip_address} 格式无效"
         
         data = {
             'type': record_type,
@@ -292,63 +1982,158 @@ class CloudflareDNSManager:
         }
         
         try:
-            response = requests.post(self.base_url, headers=self.headers, json=data, timeout=10)
+            if record_id:
+                response = self._api_request('PUT', f"{self.base_url}/{record_id}", json=data)
+            else:
+                response = self._api_request('POST', self.base_url, json=data)
             
             if response.status_code == 200:
                 result = response.json()
                 if result.get('success'):
-                    log_msg = f"DNS创建成功: {record_type}记录：{ip_address}"
+                    if isinstance(result.get('result'), dict) and 'id' in result['result']:
+                        self._cache_store(dict(result['result'], name=result['result'].get('name', name)))
+                    log_msg = f"DNS{action}成功: {record_type}记录：{ip_address}"
                     print(log_msg)
-                    return f"{record_type}记录: {ip_address} 解析 {name} 成功"
+                    return True, f"{record_type}记录: {ip_address} 解析 {name} 成功" + ("（原地更新）" if record_id else "")
                 else:
                     errors = result.get('errors', [])
                     error_msg = ', '.join([str(err) for err in errors])
-                    print(f"DNS创建失败: {error_msg}")
-                    return f"{record_type}记录: {ip_address} 解析 {name} 失败: {error_msg}"
+                    print(f"DNS{action}失败: {error_msg}")
+                    return False, f"{record_type}记录: {ip_address} 解析 {name} 失败: {error_msg}"
             else:
-                print(f"DNS创建失败: {response.text}")
-                return f"{record_type}记录: {ip_address} 解析 {name} 失败"
+                print(f"DNS{action}失败: {response.text}")
+                return False, f"{record_type}记录: {ip_address} 解析 {name} 失败"
         except Exception as e:
-            print(f"DNS创建异常: {e}")
-            return f"{record_type}记录: {ip_address} 解析 {name} 异常"
+            print(f"DNS{action}异常: {e}")
+            return False, f"{record_type}记录: {ip_address} 解析 {name} 异常"
     
-    def delete_all_dns_records(self, name: str, record_type: str = None) -> Tuple[List[str], str]:
-        """删除指定域名的所有DNS记录或特定类型的记录"""
+    def reconcile_dns_records(self, name: str, record_type: str, desired_ips: List[str]) -> Tuple[List[str], str]:
+        """按差异同步DNS记录：IP未变的记录保留，多余记录原地更新为新IP，不足的新建，剩余的删除"""
         if not self.validate_config():
-            return [], "删除失败: 缺少API配置"
+            return [], "同步失败: 缺少API配置"
         
-        print(f"开始删除 {name} 的DNS记录" + (f"（类型: {record_type}）" if record_type else ""))
+        desired = list(dict.fromkeys(desired_ips))
+        current = self.get_dns_records(name, record_type)
         
-        # 获取要删除的记录
-        records_to_delete = self.get_dns_records(name, record_type)
-        
-        if not records_to_delete:
-            msg = f"没有找到 {name} 的DNS记录" + (f"（类型: {record_type}）" if record_type else "")
-            print(msg)
-            return [], msg
+        kept = []
+        stale = []
+        for record in current:
+            if record['content'] in desired and record['content'] not in kept:
+                kept.append(record['content'])
+            else:
+                stale.append(record)
+        to_add = [ip for ip in desired if ip not in kept]
         
-        delete_results = []
-        deleted_count = 0
+        updates = list(zip(stale, to_add))
+        creates = to_add[len(updates):]
+        deletes = stale[len(updates):]
+        print(f"{name} {record_type}记录差异: 保留 {len(kept)}，更新 {len(updates)}，新增 {len(creates)}，删除 {len(deletes)}")
         
-        for record in records_to_delete:
-            record_id = record['id']
-            record_type = record['type']
-            record_content = record['content']
-            
-            success, message = self.delete_dns_record(record_id)
-            delete_results.append(message)
-            
-            if success:
-                deleted_count += 1
-                print(f"已删除 {record_type} 记录: {record_content}")
+        results = [f"{record_type}记录: {ip} 未变化，保留" for ip in kept]
+        if updates or creates or deletes:
+            change_results, succeeded = self.apply_changes(name, record_type, updates, creates, deletes)
+            results.extend(change_results)
+        else:
+            succeeded = 0
         
-        summary = f"删除完成: 成功删除 {deleted_count}/{len(records_to_delete)} 条记录"
+        total = len(updates) + len(creates) + len(deletes)
+        summary = (f"{record_type}记录同步完成: 保留 {len(kept)}，更新 {len(updates)}，新增 {len(creates)}，"
+                   f"删除 {len(deletes)}，操作成功 {succeeded}/{total}")
         print(summary)
+        return results, summary
+    
+    def apply_changes(self, name: str, record_type: str, updates: List[Tuple[Dict, str]], creates: List[str],
+                      deletes: List[Dict]) -> Tuple[List[str], int]:
+        """提交一组记录变更，返回 (结果描述列表, 成功的操作数)
+        
+        优先通过批量接口在一次请求中原子地完成全部变更；接口不可用时回退为并发逐条调用。
+        """
+        if self.batch_supported:
+            batch_result = self._apply_batch(name, record_type, updates, creates, deletes)
+            if batch_result is not None:
+                return batch_result
+        return self._apply_concurrently(name, record_type, updates, creates, deletes)
+    
+    def _apply_batch(self, name: str, record_type: str, updates: List[Tuple[Dict, str]], creates: List[str],
+                     deletes: List[Dict]) -> Optional[Tuple[List[str], int]]:
+        """调用 dns_records/batch 接口；只有接口不存在（404/405）或无法建立连接时返回 None，由调用方改为逐条提交
+        
+        其他失败（读取超时、429、校验错误等）时服务器可能已经应用了部分或全部变更，逐条重放会产生重复记录，
+        因此只报告失败，并清除该域名的记录缓存，下次同步时重新获取实际状态。
+        """
+        def record_data(ip_address: str) -> Dict:
+            return {'type': record_type, 'name': name, 'content': ip_address, 'proxied': False}
+        
+        payload = {
+            'deletes': [{'id': record['id']} for record in deletes],
+            'puts': [dict(record_data(ip), id=record['id']) for record, ip in updates],
+            'posts': [record_data(ip) for ip in creates],
+        }
         
-        return delete_results, summary
+        def failed(reason: str) -> Tuple[List[str], int]:
+            with self.cache_lock:
+                self.records_cache.pop(name, None)
+            message = f"批量DNS变更失败: {reason}"
+            print(message)
+            return [message], 0
+        
+        try:
+            response = self._api_request('POST', f"{self.base_url}/batch", json=payload, timeout=30)
+        except requests.RequestException as e:
+            if self._is_connect_error(e):
+                print(f"无法连接批量DNS接口: {e}，改为逐条提交")
+                return None
+            return failed(f"请求异常 {e}")
+        
+        if response.status_code in (404, 405):
+            print(f"批量DNS接口不可用（HTTP {response.status_code}），改为逐条提交")
+            self.batch_supported = False
+            return None
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+        if response.status_code != 200 or not result.get('success'):
+            errors = '; '.join(str(error.get('message', error) if isinstance(error, dict) else error)
+                               for error in result.get('errors') or [])
+            return failed(f"HTTP {response.status_code}" + (f"（{errors}）" if errors else ""))
+        
+        changes = result.get('result') or {}
+        for record in deletes:
+            self._cache_remove(record['id'])
+        for record in (changes.get('puts') or []) + (changes.get('posts') or []):
+            self._cache_store(dict(record, name=record.get('name', name)))
+        
+        results = [f"{record_type}记录: {ip} 解析 {name} 成功（原地更新）" for _, ip in updates]
+        results += [f"{record_type}记录: {ip} 解析 {name} 成功" for ip in creates]
+        results += [f"记录ID: {record['id']} 删除成功" for record in deletes]
+        print(f"批量DNS变更成功: {len(results)} 项操作")
+        return results, len(results)
+    
+    def _apply_concurrently(self, name: str, record_type: str, updates: List[Tuple[Dict, str]], creates: List[str],
+                            deletes: List[Dict]) -> Tuple[List[str], int]:
+        """并发逐条提交：更新和新建先执行，删除放在最后，保证同步过程中域名始终有可用记录"""
+        results = []
+        succeeded = 0
+        with ThreadPoolExecutor(max_workers=DNS_MAX_WORKERS) as executor:
+            futures = [executor.submit(self.update_dns_record, record['id'], name, ip, record_type) for record, ip in updates]
+            futures += [executor.submit(self._write_dns_record, name, ip, record_type) for ip in creates]
+            for future in futures:
+                success, message = future.result()
+                succeeded += int(success)
+                results.append(message)
+            
+            # 新记录就绪后再删除多余的旧记录
+            for future in [executor.submit(self.delete_dns_record, record['id']) for record in deletes]:
+                success, message = future.result()
+                succeeded += int(success)
+                results.append(message)
+        
+        return results, succeeded
 
 class NotificationManager:
     @staticmethod
+    @METRICS.timed('notify')
     def push_notification(content: str):
         """Telegram消息推送"""
         if not BOT_TOKEN or not CHAT_ID:
@@ -373,6 +2158,7 @@ class NotificationManager:
             print(f"消息推送异常: {e}")
     
     @staticmethod
+    @METRICS.timed('save')
     def save_ips_to_file(ip_list: List[str], filename: str = 'cfip.txt'):
         """将IP地址保存到文件"""
         try:
@@ -385,6 +2171,239 @@ class NotificationManager:
             print(f"保存IP地址到文件失败: {e}")
             return False
 
+class IPMonitorDaemon:
+    """常驻模式：内存中保存优选IP池，定期复测已发布的IP，发现故障后用备用IP原地替换对应的DNS记录
+    
+    启动时做一次完整搜索并发布；之后每 MONITOR_INTERVAL 秒复测所有已发布的IP，连续失败
+    MONITOR_FAIL_THRESHOLD 次即从IP池中取出一个备用IP（切换前再确认一次可用），通过 PUT 更新
+    该条记录，其余记录保持不动。后台线程每 REPLENISH_INTERVAL 秒刷新一次IP池，备用IP不足时立即补充。
+    """
+    
+    def __init__(self, targets: List[Dict], history: Optional[IPHistoryStore] = None):
+        self.targets = targets
+        self.history = history
+        self.ip_manager = CloudflareIPManager(history)
+        rate_limiter = TokenBucket(API_RATE_LIMIT, API_BURST)
+        self.dns_managers = {
+            zone: CloudflareDNSManager(zone, rate_limiter) for zone in dict.fromkeys(t['zone'] for t in targets)
+        }
+        self.families = [False] + ([True] if GENERATE_IPV6 else [])
+        self.needed = {is_ipv6: required_ip_count(targets, is_ipv6) for is_ipv6 in self.families}
+        # 按评分排序的IP池（包含已发布的IP），故障IP会被移出
+        self.pools: Dict[bool, List[str]] = {is_ipv6: [] for is_ipv6 in self.families}
+        self.failures: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.replenish_event = threading.Event()
+    
+    def pool_target(self, is_ipv6: bool) -> int:
+        return self.needed[is_ipv6] + MONITOR_POOL_SPARE
+    
+    def refill(self, manager: CloudflareIPManager, is_ipv6: bool, force: bool = False):
+        """搜索新的优选IP并并入IP池；force 为 False 时只在IP池不足时搜索"""
+        with self.lock:
+            if not force and len(self.pools[is_ipv6]) >= self.pool_target(is_ipv6):
+                return
+        found = manager.generate_and_test_ips(num_ips=self.pool_target(is_ipv6), is_ipv6=is_ipv6)
+        with self.lock:
+            # 新搜索到的IP评分更新，排在前面；旧IP保留在后面作为补充
+            merged = list(dict.fromkeys(found + self.pools[is_ipv6]))
+            self.pools[is_ipv6] = merged[:self.pool_target(is_ipv6) * 2]
+            print(f"{'IPv6' if is_ipv6 else 'IPv4'} IP池已更新: {len(self.pools[is_ipv6])} 个")
+    
+    def replenish_loop(self):
+        # 独立的管理器实例，避免与复测线程共享会话和评分状态
+        manager = CloudflareIPManager(self.history)
+        while not self.stop_event.is_set():
+            triggered = self.replenish_event.wait(REPLENISH_INTERVAL)
+            self.replenish_event.clear()
+            if self.stop_event.is_set():
+                break
+            for is_ipv6 in self.families:
+                try:
+                    with METRICS.span('replenish'):
+                        self.refill(manager, is_ipv6, force=not triggered)
+                except Exception as e:
+                    print(f"补充{'IPv6' if is_ipv6 else 'IPv4'} IP池失败: {e}")
+    
+    def published_records(self) -> List[Tuple[Dict, Dict]]:
+        records = []
+        for target in self.targets:
+            manager = self.dns_managers[target['zone']]
+            for record in manager.get_dns_records(target['name'], target['type']):
+                records.append((target, record))
+        return records
+    
+    @METRICS.timed('monitor_check')
+    def check_once(self) -> int:
+        """复测所有已发布的IP，替换连续失败的IP，返回替换的记录数"""
+        records = self.published_records()
+        ips = list(dict.fromkeys(record['content'] for _, record in records))
+        if not ips:
+            return 0
+        
+        results = {
+            ip: success for ip, success, _, _, _ in
+            self.ip_manager.probe_ips_stream(ips, TEST_URL_TEMPLATE, EXPECTED_STATUS_CODE)
+        }
+        if self.history:
+            self.history.record_results([(ip, success, self.ip_manager.probe_latency.get(ip)) for ip, success in results.items()])
+        
+        bad = set()
+        for ip in ips:
+            if results.get(ip):
+                self.failures.pop(ip, None)
+                continue
+            self.failures[ip] = self.failures.get(ip, 0) + 1
+            logger.info(f"已发布IP {ip} 复测失败（连续 {self.failures[ip]} 次）")
+            if self.failures[ip] >= MONITOR_FAIL_THRESHOLD:
+                bad.add(ip)
+        if not bad:
+            return 0
+        
+        with self.lock:
+            for is_ipv6 in self.families:
+                self.pools[is_ipv6] = [ip for ip in self.pools[is_ipv6] if ip not in bad]
+        
+        swaps = []
+        kept = set()  # 仍有记录指向的故障IP，保留失败计数，下次复测失败时立即重试替换
+        for target, record in records:
+            if record['content'] in bad:
+                outcome = self.swap(target, record, bad)
+                if outcome is None or not outcome[0]:
+                    kept.add(record['content'])
+                if outcome:
+                    swaps.append(outcome[1])
+        for ip in bad - kept:
+            self.failures.pop(ip, None)
+        
+        if swaps:
+            NotificationManager.push_notification('\n'.join(["**Cloudflare IP故障切换**"] + swaps))
+        return len(swaps)
+    
+    def swap(self, target: Dict, record: Dict, bad: set) -> Optional[Tuple[bool, str]]:
+        """用备用IP原地替换一条故障记录，返回 (是否成功, 结果描述)，没有备用IP时返回 None"""
+        is_ipv6 = target['type'] == 'AAAA'
+        manager = self.dns_managers[target['zone']]
+        in_use = {r['content'] for r in manager.get_dns_records(target['name'], target['type'])}
+        
+        while True:
+            with self.lock:
+                candidates = [ip for ip in self.pools.get(is_ipv6, []) if ip not in in_use and ip not in bad]
+            if not candidates:
+                print(f"{target['name']} {target['type']}: 没有可用的备用IP，保留故障记录 {record['content']}")
+                self.replenish_event.set()
+                return None
+            
+            candidate = candidates[0]
+            # 切换前再确认一次备用IP可用
+            if self.ip_manager.probe_ip_status(candidate, TEST_URL_TEMPLATE, EXPECTED_STATUS_CODE)[0]:
+                break
+            bad.add(candidate)
+            with self.lock:
+                self.pools[is_ipv6] = [ip for ip in self.pools[is_ipv6] if ip != candidate]
+        
+        success, message = manager.update_dns_record(record['id'], target['name'], candidate, target['type'])
+        METRICS.inc('dns_swaps', 'ok' if success else 'failed', label_name='result')
+        with self.lock:
+            spare = len(self.pools[is_ipv6]) - self.needed[is_ipv6]
+        if spare < MONITOR_POOL_SPARE:
+            self.replenish_event.set()
+        result = f"{target['name']} {target['type']}: {record['content']} -> {candidate} " + ("成功" if success else f"失败（{message}）")
+        print(f"故障切换 {result}")
+        return success, result
+    
+    def run(self):
+        for is_ipv6 in self.families:
+            self.refill(self.ip_manager, is_ipv6, force=True)
+        
+        print(f"\n发布初始IP到 {len(self.targets)} 个DNS目标...")
+        # 只发布排名靠前的 needed 个IP，其余留在IP池中作为故障切换的备用IP
+        published = {is_ipv6: self.pools[is_ipv6][:self.needed[is_ipv6]] for is_ipv6 in self.families}
+        for outcome in publish_dns_targets(self.targets, published[False], published.get(True, [])):
+            print(f"{outcome['target']['name']} {outcome['target']['type']}: {outcome['summary']}")
+        for target in self.targets:
+            # 初始发布用的是独立的API客户端，这里重新拉取一次记录
+            self.dns_managers[target['zone']].get_dns_records(target['name'], use_cache=False)
+        
+        replenisher = threading.Thread(target=self.replenish_loop, name='replenish', daemon=True)
+        replenisher.start()
+        print(f"\n进入监控循环: 每 {MONITOR_INTERVAL:g} 秒复测已发布的IP，连续失败 {MONITOR_FAIL_THRESHOLD} 次即切换")
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.check_once()
+                except Exception as e:
+                    print(f"复测已发布IP时出错: {e}")
+                self.stop_event.wait(MONITOR_INTERVAL)
+        finally:
+            self.stop_event.set()
+            self.replenish_event.set()
+            replenisher.join(timeout=5)
+
+def load_dns_targets() -> List[Dict]:
+    """读取DNS发布目标列表
+    
+    DNS_TARGETS 可以是JSON字符串或JSON文件路径，每项包含 zone（默认 CF_ZONE_ID）、name、
+    type（A/AAAA，默认A）和 count（发布的IP数量，默认使用全部优选结果，最多10个）。
+    未配置时使用 CF_DNS_NAME 的A和AAAA记录作为默认目标。
+    """
+    if DNS_TARGETS:
+        try:
+            if os.path.isfile(DNS_TARGETS):
+                with open(DNS_TARGETS, 'r', encoding='utf-8') as file:
+                    raw_targets = json.load(file)
+            else:
+                raw_targets = json.loads(DNS_TARGETS)
+        except (OSError, ValueError) as e:
+            print(f"解析 DNS_TARGETS 失败: {e}")
+            return []
+    elif CF_DNS_NAME:
+        raw_targets = [{'name': CF_DNS_NAME, 'type': 'A'}, {'name': CF_DNS_NAME, 'type': 'AAAA'}]
+    else:
+        return []
+    
+    targets = []
+    for raw in raw_targets:
+        target = {
+            'zone': raw.get('zone') or CF_ZONE_ID,
+            'name': raw.get('name'),
+            'type': str(raw.get('type', 'A')).upper(),
+            'count': int(raw['count']) if raw.get('count') else None,
+        }
+        if not target['zone'] or not target['name'] or target['type'] not in ('A', 'AAAA'):
+            print(f"跳过无效的DNS目标: {raw}")
+            continue
+        targets.append(target)
+    return targets
+
+def required_ip_count(targets: List[Dict], is_ipv6: bool) -> int:
+    """满足所有同类型DNS目标所需的优选IP数量"""
+    record_type = 'AAAA' if is_ipv6 else 'A'
+    default = IPV6_COUNT if is_ipv6 else 3
+    return max([default] + [min(t['count'], 10) for t in targets if t['type'] == record_type and t['count']])
+
+@METRICS.timed('dns')
+def publish_dns_targets(targets: List[Dict], ipv4_pool: List[str], ipv6_pool: List[str]) -> List[Dict]:
+    """把同一批优选IP并发发布到所有DNS目标，返回每个目标的 {'target', 'results', 'summary'}"""
+    rate_limiter = TokenBucket(API_RATE_LIMIT, API_BURST)
+    managers = {}
+    for target in targets:
+        if target['zone'] not in managers:
+            managers[target['zone']] = CloudflareDNSManager(target['zone'], rate_limiter)
+    
+    def publish(target: Dict) -> Dict:
+        pool = ipv6_pool if target['type'] == 'AAAA' else ipv4_pool
+        desired = pool[:min(target['count'] or 10, 10)]
+        if not desired and (target['type'] == 'A' or GENERATE_IPV6):
+            # 本次没有可用IP时保留现有记录；未启用IPv6时则清空AAAA记录
+            return {'target': target, 'results': [], 'summary': f"没有可用的{'IPv6' if target['type'] == 'AAAA' else 'IPv4'}地址，保留现有{target['type']}记录"}
+        results, summary = managers[target['zone']].reconcile_dns_records(target['name'], target['type'], desired)
+        return {'target': target, 'results': results, 'summary': summary}
+    
+    with ThreadPoolExecutor(max_workers=max(min(len(targets), DNS_MAX_WORKERS), 1)) as executor:
+        return list(executor.map(publish, targets))
+
 def main():
     """主函数"""
     print("=" * 60)
@@ -397,44 +2416,61 @@ def main():
     print(f"  - 请求超时: {REQUEST_TIMEOUT}秒")
     print(f"  - 生成IPv6: {GENERATE_IPV6}")
     print(f"  - 并发数: {MAX_WORKERS}")
+    print(f"  - TCP预筛选: {TCP_PREFILTER}" + (f" (每轮候选数: {TCP_PREFILTER_CANDIDATES})" if TCP_PREFILTER else ""))
+    print(f"  - 评分采样: " + (f"每IP {PROBE_SAMPLES} 次TCP握手" if PROBE_SAMPLES > 0 else "使用探测首字节耗时")
+          + f"，候选池 = 目标数量 × {RANK_POOL_FACTOR}")
+    print(f"  - 下载测速: {SPEED_TEST}" + (f" (入围数: {SPEED_TEST_COUNT}, 上限 {SPEED_TEST_MAX_SECONDS}秒/{SPEED_TEST_MAX_BYTES}字节)" if SPEED_TEST else ""))
+    print(f"  - 历史记录: {IP_HISTORY_DB or '未启用'}")
+    print(f"  - 搜索策略: {SEARCH_STRATEGY}")
+    if SEARCH_STRATEGY == 'vectorized' and np is None:
+        print("    警告: 未安装numpy，向量化生成不可用，改用分层采样")
+    print(f"  - 探测引擎: {PROBE_ENGINE}" + (f" (异步并发上限: {ASYNC_CONCURRENCY})" if PROBE_ENGINE == 'asyncio' else f" (探测方式: {PROBE_METHOD})"))
     if GENERATE_IPV6:
         print(f"  - IPv6数量: {IPV6_COUNT}")
     
     # 初始化管理器
-    ip_manager = CloudflareIPManager()
-    dns_manager = CloudflareDNSManager()
+    history = IPHistoryStore(IP_HISTORY_DB) if IP_HISTORY_DB else None
+    sources = SourceRegistry() if SEED_IP_FILES else None
+    ip_manager = CloudflareIPManager(history, sources)
     notification_manager = NotificationManager()
+    dns_targets = load_dns_targets()
     
-    # 生成并测试IPv4地址
-    num_ipv4 = 3
+    # 生成并测试IPv4地址，数量满足所有DNS目标的需要
+    num_ipv4 = required_ip_count(dns_targets, is_ipv6=False)
     print(f"\n正在生成并测试 {num_ipv4} 个IPv4地址...")
     print(f"要求IP地址返回状态码: {EXPECTED_STATUS_CODE}")
     
-    generated_ipv4 = ip_manager.generate_and_test_ips(num_ips=num_ipv4, is_ipv6=False)
+    if RANKED_IPS_FILE:
+        generated_ipv4 = ip_manager.load_ranked_ips(RANKED_IPS_FILE, num_ipv4, is_ipv6=False)
+    else:
+        generated_ipv4 = ip_manager.generate_and_test_ips(num_ips=num_ipv4, is_ipv6=False)
     
     if not generated_ipv4:
         print("警告: 无法生成任何符合条件的IPv4地址")
         generated_ipv4 = []
     else:
-        print(f"\n成功生成 {len(generated_ipv4)} 个符合条件的IPv4地址:")
+        print(f"\n成功生成 {len(generated_ipv4)} 个符合条件的IPv4地址（按评分排序）:")
         for i, ip in enumerate(generated_ipv4, 1):
-            print(f"{i}. {ip}")
+            print(f"{i}. {ip_manager.describe_ip(ip)}")
     
     # 生成并测试IPv6地址（如果启用）
     generated_ipv6 = []
     if GENERATE_IPV6:
-        num_ipv6 = IPV6_COUNT
+        num_ipv6 = required_ip_count(dns_targets, is_ipv6=True)
         print(f"\n正在生成并测试 {num_ipv6} 个IPv6地址...")
         
-        generated_ipv6 = ip_manager.generate_and_test_ips(num_ips=num_ipv6, is_ipv6=True)
+        if RANKED_IPS_FILE:
+            generated_ipv6 = ip_manager.load_ranked_ips(RANKED_IPS_FILE, num_ipv6, is_ipv6=True)
+        else:
+            generated_ipv6 = ip_manager.generate_and_test_ips(num_ips=num_ipv6, is_ipv6=True)
         
         if not generated_ipv6:
             print("警告: 无法生成任何符合条件的IPv6地址")
             generated_ipv6 = []
         else:
-            print(f"\n成功生成 {len(generated_ipv6)} 个符合条件的IPv6地址:")
+            print(f"\n成功生成 {len(generated_ipv6)} 个符合条件的IPv6地址（按评分排序）:")
             for i, ip in enumerate(generated_ipv6, 1):
-                print(f"{i}. {ip}")
+                print(f"{i}. {ip_manager.describe_ip(ip)}")
     
     # 保存IP到文件
     if generated_ipv4:
@@ -443,73 +2479,35 @@ def main():
         notification_manager.save_ips_to_file(generated_ipv6, 'cfipv6.txt')
     
     # 更新DNS记录（如果配置了环境变量）
-    if dns_manager.validate_config():
-        print("\n开始更新DNS记录...")
+    if CF_API_TOKEN and dns_targets:
+        print(f"\n开始更新DNS记录（共 {len(dns_targets)} 个目标）...")
         push_content = []
         
-        # 1. 删除所有现有的A记录和AAAA记录
-        print("步骤1: 删除现有DNS记录...")
-        
-        # 删除所有A记录
-        a_delete_results, a_delete_summary = dns_manager.delete_all_dns_records(CF_DNS_NAME, 'A')
-        push_content.append(f"**A记录删除结果:**")
-        push_content.append(a_delete_summary)
-        
-        # 删除所有AAAA记录
-        aaaa_delete_results, aaaa_delete_summary = dns_manager.delete_all_dns_records(CF_DNS_NAME, 'AAAA')
-        push_content.append(f"**AAAA记录删除结果:**")
-        push_content.append(aaaa_delete_summary)
-        
-        # 2. 创建新的DNS记录
-        print("\n步骤2: 创建新的DNS记录...")
-        create_results = []
-        
-        # 创建A记录（IPv4）
-        if generated_ipv4:
-            print(f"创建A记录...")
-            # 限制创建的A记录数量，避免过多
-            max_a_records = min(10, len(generated_ipv4))
-            for i in range(max_a_records):
-                ip_address = generated_ipv4[i]
-                result = dns_manager.create_dns_record(CF_DNS_NAME, ip_address, 'A')
-                create_results.append(result)
-                print(f"创建A记录 {i+1}/{max_a_records}: {ip_address}")
-        else:
-            create_results.append("没有可用的IPv4地址，跳过A记录创建")
-        
-        # 创建AAAA记录（IPv6）
-        if generated_ipv6 and GENERATE_IPV6:
-            print(f"创建AAAA记录...")
-            # 限制创建的AAAA记录数量，避免过多
-            max_aaaa_records = min(10, len(generated_ipv6))
-            for i in range(max_aaaa_records):
-                ip_address = generated_ipv6[i]
-                result = dns_manager.create_dns_record(CF_DNS_NAME, ip_address, 'AAAA')
-                create_results.append(result)
-                print(f"创建AAAA记录 {i+1}/{max_aaaa_records}: {ip_address}")
-        elif GENERATE_IPV6:
-            create_results.append("没有可用的IPv6地址，跳过AAAA记录创建")
-        
-        # 3. 汇总结果
-        push_content.append(f"\n**新记录创建结果:**")
-        push_content.extend(create_results)
+        # 按差异同步每个目标的记录，IP未变的记录保持不动
+        multiple_zones = len({target['zone'] for target in dns_targets}) > 1
+        for outcome in publish_dns_targets(dns_targets, generated_ipv4, generated_ipv6):
+            target = outcome['target']
+            zone = f" (区域 {target['zone']})" if multiple_zones else ""
+            push_content.append(f"\n**{target['name']} {target['type']}记录同步结果{zone}:**")
+            push_content.append(outcome['summary'])
+            push_content.extend(outcome['results'])
         
         # 添加摘要信息到推送内容
         summary_content = []
         summary_content.append(f"**Cloudflare IP优选及DNS更新**")
         summary_content.append(f"更新时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}")
         summary_content.append(f"测试配置: 期望状态码={EXPECTED_STATUS_CODE}")
-        summary_content.append(f"域名: {CF_DNS_NAME}")
+        summary_content.append(f"域名: {', '.join(dict.fromkeys(target['name'] for target in dns_targets))}")
         
         if generated_ipv4:
             summary_content.append(f"\n**IPv4地址 ({len(generated_ipv4)}个):**")
-            summary_content.append(", ".join(generated_ipv4[:5]))
+            summary_content.append("\n".join(ip_manager.describe_ip(ip) for ip in generated_ipv4[:5]))
             if len(generated_ipv4) > 5:
                 summary_content.append(f"... 等共 {len(generated_ipv4)} 个地址")
         
         if generated_ipv6:
             summary_content.append(f"\n**IPv6地址 ({len(generated_ipv6)}个):**")
-            summary_content.append(", ".join(generated_ipv6[:3]))
+            summary_content.append("\n".join(ip_manager.describe_ip(ip) for ip in generated_ipv6[:3]))
             if len(generated_ipv6) > 3:
                 summary_content.append(f"... 等共 {len(generated_ipv6)} 个地址")
         
@@ -523,24 +2521,76 @@ def main():
         print("\n未更新DNS记录，原因:")
         if not CF_API_TOKEN:
             print("- 缺少 CF_API_TOKEN")
-        if not CF_ZONE_ID:
-            print("- 缺少 CF_ZONE_ID")
-        if not CF_DNS_NAME:
-            print("- 缺少 CF_DNS_NAME")
+        if not dns_targets:
+            print("- 缺少 CF_ZONE_ID 和 CF_DNS_NAME，或 DNS_TARGETS 中没有有效目标")
         
         if generated_ipv4:
             print(f"\nIPv4地址已保存到 cfip.txt 文件")
         if generated_ipv6:
             print(f"IPv6地址已保存到 cfipv6.txt 文件")
     
+    if history:
+        history.close()
+    if sources and sources.state:
+        print("\n候选IP来源统计:")
+        for line in sources.summary():
+            print(f"  {line}")
+    
     print("=" * 60)
     print("程序执行完毕")
 
+def daemon_main():
+    """守护模式入口"""
+    dns_targets = load_dns_targets()
+    if not CF_API_TOKEN or not dns_targets:
+        print("守护模式需要 CF_API_TOKEN 以及 CF_ZONE_ID/CF_DNS_NAME 或 DNS_TARGETS")
+        return
+    
+    history = IPHistoryStore(IP_HISTORY_DB) if IP_HISTORY_DB else None
+    daemon = IPMonitorDaemon(dns_targets, history)
+    # 收到 SIGTERM 时完成当前一轮后退出
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop_event.set())
+    try:
+        daemon.run()
+    finally:
+        if history:
+            history.close()
+
+def sweep_main():
+    """全量扫描入口：扫描 SWEEP_CIDR_FILE 中的全部地址并生成排名表"""
+    print("=" * 60)
+    print("Cloudflare IP全量扫描")
+    print("=" * 60)
+    print(f"  - CIDR文件: {SWEEP_CIDR_FILE}")
+    print(f"  - 结果文件: {SWEEP_OUTPUT}")
+    print(f"  - 排名表: {SWEEP_RANKED_OUTPUT}")
+    print(f"  - 检查点: {SWEEP_CHECKPOINT}")
+    print(f"  - HTTP检测: {SWEEP_HTTP_CHECK} (探测引擎: {PROBE_ENGINE})")
+    print(f"  - TCP并发数: {TCP_CONNECT_CONCURRENCY}")
+    
+    sweeper = CIDRSweeper(CloudflareIPManager())
+    sweeper.run()
+    sweeper.rank()
+    
+    print("=" * 60)
+    print(f"扫描完毕，可设置 RANKED_IPS_FILE={SWEEP_RANKED_OUTPUT} 将排名结果用于DNS更新")
+
 if __name__ == "__main__":
+    logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO), format='%(message)s', stream=sys.stdout)
+    METRICS.set_info('run_mode', RUN_MODE)
     try:
-        main()
+        if RUN_MODE == 'sweep':
+            sweep_main()
+        elif RUN_MODE == 'daemon':
+            daemon_main()
+        else:
+            main()
     except KeyboardInterrupt:
         print("\n用户中断程序执行")
+        METRICS.set_info('interrupted', True)
     except Exception as e:
         print(f"程序执行出现异常: {e}")
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+        METRICS.set_info('error', str(e))
+    finally:
+        METRICS.write()
\ No newline at end of file
@@ -0,0 +1,157 @@
+import ipaddress
+import os
+import socket
+from bisect import bisect_right
+from typing import List, Dict, Tuple, Optional, Iterable
+
+try:
+    import numpy as np
+except ImportError:  # numpy 可选，缺失时批量查询退回逐个二分查找
+    np = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CIDR_FILES = (os.path.join(BASE_DIR, 'cfasn'), os.path.join(BASE_DIR, 'cfipv6'))
+# cfipv6 只包含零散的 /96 网段，域名解析得到的 IPv6 地址大多不在其中，因此默认补充 Cloudflare 公布的 IPv6 地址段
+CLOUDFLARE_IPV6_RANGES = (
+    '2400:cb00::/32', '2606:4700::/32', '2803:f800::/32', '2405:b500::/32',
+    '2405:8100::/32', '2a06:98c0::/29', '2c0f:f248::/32',
+)
+
+
+def ip_to_int(ip: str) -> Optional[Tuple[int, int]]:
+    """把IP字符串转换为 (版本, 整数)，无效地址返回 None"""
+    try:
+        if ':' in ip:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+class CIDRIndex:
+    """Cloudflare地址范围索引：判断IP是否属于Cloudflare地址空间，以及属于哪个网段
+
+    每个地址族把网段整理为按起始地址排序、互不重叠的区间数组 (starts, ends, labels)，
+    单个查询用 bisect 二分查找；批量查询IPv4时用 numpy.searchsorted 一次完成。
+    CIDR之间只有包含或不相交两种关系，被包含的子网段合并到外层网段中，查询结果为最外层网段。
+    """
+
+    def __init__(self, cidrs: Iterable[str]):
+        networks = {4: [], 6: []}
+        for cidr in cidrs:
+            cidr = cidr.strip()
+            if not cidr or cidr.startswith('#'):
+                continue
+            try:
+                network = ipaddress.ip_network(cidr, strict=False)
+            except ValueError:
+                continue
+            networks[network.version].append(
+                (int(network.network_address), int(network.broadcast_address), str(network))
+            )
+
+        self.starts: Dict[int, List[int]] = {}
+        self.ends: Dict[int, List[int]] = {}
+        self.labels: Dict[int, List[str]] = {}
+        for version, items in networks.items():
+            # 起始地址相同时较大的网段排在前面，后续被其包含的网段直接跳过
+            items.sort(key=lambda item: (item[0], -item[1]))
+            starts, ends, labels = [], [], []
+            for start, end, label in items:
+                if ends and start <= ends[-1]:
+                    continue
+                starts.append(start)
+                ends.append(end)
+                labels.append(label)
+            self.starts[version] = starts
+            self.ends[version] = ends
+            self.labels[version] = labels
+
+        self._np_starts = self._np_ends = None
+        if np is not None and self.starts[4]:
+            self._np_starts = np.array(self.starts[4], dtype=np.uint64)
+            self._np_ends = np.array(self.ends[4], dtype=np.uint64)
+
+    @classmethod
+    def from_files(cls, paths: Iterable[str] = DEFAULT_CIDR_FILES,
+                   extra: Iterable[str] = CLOUDFLARE_IPV6_RANGES) -> 'CIDRIndex':
+        """从 cfasn / cfipv6 等每行一个CIDR的文件以及 extra 中的网段构建索引，不存在的文件会被忽略"""
+        cidrs = list(extra)
+        for path in paths:
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    cidrs.extend(file.read().splitlines())
+            except OSError as e:
+                print(f"读取CIDR文件 {path} 失败: {e}")
+        return cls(cidrs)
+
+    def __len__(self) -> int:
+        return len(self.starts[4]) + len(self.starts[6])
+
+    def __contains__(self, ip: str) -> bool:
+        return self.lookup(ip) is not None
+
+    def _find(self, version: int, value: int) -> Optional[str]:
+        position = bisect_right(self.starts[version], value) - 1
+        if position >= 0 and value <= self.ends[version][position]:
+            return self.labels[version][position]
+        return None
+
+    def lookup(self, ip: str) -> Optional[str]:
+        """返回IP所属的网段，不在Cloudflare地址空间内（或地址无效）时返回 None"""
+        parsed = ip_to_int(ip)
+        if parsed is None:
+            return None
+        return self._find(*parsed)
+
+    def lookup_many(self, ips: List[str]) -> List[Optional[str]]:
+        """批量查询，结果与输入一一对应"""
+        results: List[Optional[str]] = [None] * len(ips)
+        v4_positions, v4_values = [], []
+        for position, ip in enumerate(ips):
+            parsed = ip_to_int(ip)
+            if parsed is None:
+                continue
+            version, value = parsed
+            if version == 4 and self._np_starts is not None:
+                v4_positions.append(position)
+                v4_values.append(value)
+            else:
+                results[position] = self._find(version, value)
+
+        if v4_values:
+            values = np.array(v4_values, dtype=np.uint64)
+            indexes = np.searchsorted(self._np_starts, values, side='right').astype(np.int64) - 1
+            clipped = np.maximum(indexes, 0)
+            matched = (indexes >= 0) & (values <= self._np_ends[clipped])
+            labels = self.labels[4]
+            for position, index, hit in zip(v4_positions, clipped.tolist(), matched.tolist()):
+                if hit:
+                    results[position] = labels[index]
+        return results
+
+    def bucket(self, ips: Iterable[str]) -> Tuple[Dict[str, List[str]], List[str]]:
+        """校验并按网段分组，返回 ({网段: [IP, ...]}, 不在地址范围内的IP列表)
+
+        分组和组内顺序都保持IP首次出现的顺序，重复的IP只保留一次。
+        """
+        unique_ips = list(dict.fromkeys(ip.strip() for ip in ips if ip and ip.strip()))
+        buckets: Dict[str, List[str]] = {}
+        rejected = []
+        for ip, label in zip(unique_ips, self.lookup_many(unique_ips)):
+            if label is None:
+                rejected.append(ip)
+            else:
+                buckets.setdefault(label, []).append(ip)
+        return buckets, rejected
+
+    @staticmethod
+    def interleave(buckets: Dict[str, List[str]]) -> List[str]:
+        """按网段轮流取IP，使列表前部尽量覆盖不同的网段"""
+        ordered = []
+        queues = [list(reversed(members)) for members in buckets.values()]
+        while queues:
+            for queue in queues:
+                ordered.append(queue.pop())
+            queues = [queue for queue in queues if queue]
+        return ordered
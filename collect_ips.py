@@ -1,55 +1,153 @@
 import re
 import os
-import selenium
-import lxml
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.chrome.options import Options
-
-service = Service(ChromeDriverManager().install())
-chrome_options = webdriver.ChromeOptions()
-chrome_options.add_argument('--headless')
-chrome_options.add_argument('--no-sandbox')
-chrome_options.add_argument('--disable-gpu')
-chrome_options.add_argument('--disable-dev-shm-usage')
-chromedriver = "/usr/local/bin/chromedriver"
-os.environ["webdriver.chrome.driver"] = chromedriver
-
-# 目标 URL 列表
-urls = [
-'https://raw.githubusercontent.com/leung7963/CFIPS/main/domain_ips.js',
-'https://www.wetest.vip/page/cloudflare/total_v4.html',
-'https://www.wetest.vip/page/cloudflare/address_v4.html',
-'https://api.uouin.com/cloudflare.html',
-'https://addressesapi.090227.xyz/CloudFlareYes'
-]
-
-# 正则表达式用于匹配 IP 地址
-ip_pattern = r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
-
-# 检查 ip.txt 文件是否存在，如果存在则删除它
-if os.path.exists('ip.js'):
-    os.remove('ip.js')
-
-# 创建一个文件来存储 IP 地址
-with open('ip.js', 'w') as file:
-    # 设置浏览器驱动
-    driver = webdriver.Chrome(options=chrome_options)
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Optional
+
+from cidr_index import CIDRIndex
+from ip_sources import SourceRegistry
+
+FETCH_TIMEOUT = float(os.environ.get("COLLECT_TIMEOUT", "10"))  # 单个来源的请求超时（秒）
+CHUNK_SIZE = 16 * 1024
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
+# 正则表达式用于匹配 IP 地址，前后不能紧挨数字或点
+ip_pattern = re.compile(rb'(?<![\d.])\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(?![\d.])')
+
+
+class IPExtractor:
+    """增量 IP 提取器：逐块输入响应内容，跨越块边界的 IP 也能完整识别"""
+    MAX_TAIL = 64
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, chunk: bytes) -> List[str]:
+        data = self.buffer + chunk
+        # 末尾由数字和点组成的部分可能是被截断的 IP，留到下一块再匹配
+        cut = len(data.rstrip(b'0123456789.'))
+        if len(data) - cut > self.MAX_TAIL:
+            cut = len(data) - self.MAX_TAIL
+        self.buffer = data[cut:]
+        return [match.decode('ascii') for match in ip_pattern.findall(data, 0, cut)]
+
+    def close(self) -> List[str]:
+        data, self.buffer = self.buffer, b''
+        return [match.decode('ascii') for match in ip_pattern.findall(data)]
+
+
+class BrowserRenderer:
+    """按需启动的无头浏览器，只在某个来源需要渲染时才导入 selenium 并创建驱动"""
+
+    def __init__(self):
+        self.driver = None
+        self.lock = threading.Lock()
+
+    def render(self, url: str) -> Optional[str]:
+        with self.lock:
+            try:
+                if self.driver is None:
+                    from selenium import webdriver
+
+                    chrome_options = webdriver.ChromeOptions()
+                    chrome_options.add_argument('--headless')
+                    chrome_options.add_argument('--no-sandbox')
+                    chrome_options.add_argument('--disable-gpu')
+                    chrome_options.add_argument('--disable-dev-shm-usage')
+                    # selenium 4.6+ 会自动获取匹配的 chromedriver
+                    self.driver = webdriver.Chrome(options=chrome_options)
+                self.driver.get(url)
+                return self.driver.page_source
+            except ImportError:
+                print(f'未安装 selenium，无法渲染 {url}')
+            except Exception as e:
+                print(f'浏览器渲染 {url} 失败: {e}')
+            return None
+
+    def close(self):
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
+
+
+def create_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'User-Agent': USER_AGENT})
+    return session
+
+
+def fetch_source(session: requests.Session, source: Dict, renderer: BrowserRenderer) -> Tuple[List[str], float]:
+    """流式下载一个来源并边下载边提取 IP；需要时回退到浏览器渲染。返回 (IP 列表, 抓取时间)"""
+    url = source['url']
+    ips = []
+    try:
+        extractor = IPExtractor()
+        with session.get(url, timeout=FETCH_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                ips.extend(extractor.feed(chunk))
+        ips.extend(extractor.close())
+    except requests.RequestException as e:
+        print(f'获取 {url} 失败: {e}')
+
+    if not ips and source.get('render'):
+        page_source = renderer.render(url)
+        if page_source:
+            extractor = IPExtractor()
+            ips = extractor.feed(page_source.encode('utf-8')) + extractor.close()
+    return ips, time.time()
+
+
+def collect_ips(sources: List[Dict]) -> List[Tuple[List[str], float]]:
+    """并发获取所有来源，返回与 sources 一一对应的 (IP 列表, 抓取时间)"""
+    session = create_session(len(sources))
+    renderer = BrowserRenderer()
+    try:
+        with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+            futures = [executor.submit(fetch_source, session, source, renderer) for source in sources]
+            return [future.result() for future in futures]
+    finally:
+        renderer.close()
+        session.close()
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    registry = SourceRegistry()
+    sources = registry.active_sources()
+    if not sources:
+        print(f'{registry.path} 中没有可用的来源')
+        exit(1)
+
+    results = collect_ips(sources)
+    index = CIDRIndex.from_files()
+    fetched = []
     all_ips = []
-    for url in urls:
-        # 打开网页
-        driver.get(url)
-        # 获取页面源代码
-        page_source = driver.page_source
-        # 使用正则表达式查找 IP 地址
-        ip_matches = re.findall(ip_pattern, page_source)
-        all_ips.extend(ip_matches)
-    driver.quit()
-
-unique_ips = list(set(all_ips))
-with open('ip.js', 'w') as file:
-    for ip in unique_ips:
-        file.write(ip + '\n')
-
-print('IP 地址已去重并保存到 ip.js 文件中。')
\ No newline at end of file
+    for source, (ips, fetched_at) in zip(sources, results):
+        # 只统计和记录属于 Cloudflare 地址范围的 IP
+        buckets, rejected = index.bucket(ips)
+        valid_ips = [ip for members in buckets.values() for ip in members]
+        print(f"{source['name']}: {len(valid_ips)} 个 IP" + (f"（丢弃 {len(rejected)} 个范围外地址）" if rejected else ""))
+        registry.record_fetch(source['name'], valid_ips, fetched_at)
+        fetched.append((source['name'], valid_ips, fetched_at))
+        all_ips.extend(valid_ips)
+
+    # 去重（保留来源信息），按网段分组后轮流输出
+    provenance = registry.build_provenance(fetched)
+    buckets, _ = index.bucket(all_ips)
+    unique_ips = CIDRIndex.interleave(buckets)
+    print(f'{len(unique_ips)} 个 IP 分布在 {len(buckets)} 个网段中，耗时 {time.time() - start_time:.2f} 秒')
+
+    with open('ip.js', 'w') as file:
+        for ip in unique_ips:
+            file.write(ip + '\n')
+    registry.save_provenance(provenance)
+    registry.save_state()
+
+    print('IP 地址已去重并保存到 ip.js 文件中。')
@@ -1,40 +1,235 @@
+import os
+import json
+import time
+import asyncio
+import ipaddress
+import dns.asyncresolver
+import dns.edns
+import dns.exception
 import dns.resolver
 import requests
+from typing import List, Dict, Set, Tuple, Optional, Union
 
+from cidr_index import CIDRIndex
+from ip_sources import read_json, write_json_atomic
 
-def get_a_records(domain):
-    a_records = []
-    try:
-        answers = dns.resolver.resolve(domain, 'A')
-        for rdata in answers:
-            a_records.append(rdata.address)
-    except dns.resolver.NoAnswer:
-        print(f"No A records found for {domain}")
-    except dns.resolver.NXDOMAIN:
-        print(f"The domain {domain} does not exist.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+DOMAIN_LIST_URL = os.environ.get("DOMAIN_LIST_URL", "https://raw.githubusercontent.com/leung7963/CFIPS/refs/heads/main/domain.js")
+DNS_CONCURRENCY = int(os.environ.get("DNS_CONCURRENCY", "200"))  # 同时进行的查询数上限
+DNS_QUERY_TIMEOUT = float(os.environ.get("DNS_QUERY_TIMEOUT", "3"))  # 单次查询超时（秒）
+DNS_RECORD_TYPES = [t.strip().upper() for t in os.environ.get("DNS_RECORD_TYPES", "A,AAAA").split(',') if t.strip()]
+DNS_CACHE_FILE = os.environ.get("DNS_CACHE_FILE", "dns_cache.json")  # 留空则不缓存
+DNS_NEGATIVE_TTL = int(os.environ.get("DNS_NEGATIVE_TTL", "300"))  # 无记录/域名不存在的结果缓存时间（秒）
+DNS_RESOLVERS = os.environ.get("DNS_RESOLVERS", "")  # 逗号分隔，形如 [名称=]8.8.8.8、1.1.1.1:53、[::1]:5353；留空使用系统解析器
+DNS_ECS_REGIONS = os.environ.get("DNS_ECS_REGIONS", "")  # 逗号分隔的 地区=子网，如 hk=1.36.0.0/16,sg=43.245.0.0/16
+DOMAIN_REGIONS_FILE = os.environ.get("DOMAIN_REGIONS_FILE", "domain_ip_regions.json")  # IP -> 地区标签
 
-    return a_records
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
 
 
-if __name__ == "__main__":
+class DNSCache:
+    """按 TTL 缓存解析结果，跨运行保存在 JSON 文件中
+
+    过期条目不会立即删除：查询失败（超时等）时退回使用上一次的结果，避免一次网络抖动清空候选列表。
+    """
+
+    def __init__(self, path: str = DNS_CACHE_FILE):
+        self.path = path
+        self.entries: Dict[str, Dict] = read_json(path, {}) if path else {}
+
+    @staticmethod
+    def key(domain: str, rdtype: str, view: str = '') -> str:
+        # view 区分不同的解析器和ECS子网，同一域名在不同视角下的应答分别缓存
+        return f"{domain}/{rdtype}@{view}" if view else f"{domain}/{rdtype}"
+
+    def get(self, domain: str, rdtype: str, view: str = '', allow_expired: bool = False) -> Optional[List[str]]:
+        entry = self.entries.get(self.key(domain, rdtype, view))
+        if entry is None or (not allow_expired and entry['expires'] <= time.time()):
+            return None
+        return entry['ips']
+
+    def put(self, domain: str, rdtype: str, view: str, ips: List[str], ttl: int):
+        self.entries[self.key(domain, rdtype, view)] = {'ips': ips, 'expires': time.time() + ttl}
+
+    def save(self, keep: Set[str]):
+        """保存缓存，只保留 keep 中的条目（即当前域名列表和解析配置对应的条目）"""
+        if not self.path:
+            return
+        entries = {key: value for key, value in self.entries.items() if key in keep}
+        try:
+            write_json_atomic(self.path, entries)
+        except OSError as e:
+            # 缓存只影响下次运行的查询量，写入失败不应中断本次输出
+            print(f"保存DNS缓存 {self.path} 失败: {e}")
+
+
+class ResolverView:
+    """一个解析视角：指定的上游解析器（或系统解析器）加上可选的ECS子网"""
+
+    def __init__(self, server: Optional[Tuple[str, int]] = None, server_label: str = '',
+                 region: str = '', subnet: Optional[IPNetwork] = None):
+        self.server = server
+        self.region = region
+        self.subnet = subnet
+        self.key = '|'.join(part for part in (server_label, f"{region}={subnet}" if subnet else '') if part)
+        # 配置了ECS时按地区打标签，否则按解析器打标签
+        self.tag = region or server_label or 'default'
+        self.resolver = create_resolver(self)
+
+    def __repr__(self) -> str:
+        return self.key or 'system'
+
+
+def parse_server(text: str) -> Tuple[str, Tuple[str, int]]:
+    """解析 [名称=]地址[:端口]，返回 (名称, (地址, 端口))"""
+    label, _, address = text.rpartition('=')
+    port = 53
+    if address.startswith('['):
+        host, _, rest = address[1:].partition(']')
+        if rest.startswith(':'):
+            port = int(rest[1:])
+    elif address.count(':') == 1:
+        host, port_text = address.split(':')
+        port = int(port_text)
+    else:
+        host = address
+    ipaddress.ip_address(host)
+    return label or (address if port != 53 else host), (host, port)
+
+
+def build_views() -> List[ResolverView]:
+    """按 DNS_RESOLVERS × DNS_ECS_REGIONS 组合出所有解析视角"""
+    servers: List[Tuple[str, Optional[Tuple[str, int]]]] = []
+    for item in DNS_RESOLVERS.split(','):
+        if item.strip():
+            try:
+                servers.append(parse_server(item.strip()))
+            except ValueError:
+                print(f"跳过无效的解析器: {item}")
+    regions: List[Tuple[str, Optional[IPNetwork]]] = []
+    for item in DNS_ECS_REGIONS.split(','):
+        if item.strip():
+            region, _, subnet = item.strip().rpartition('=')
+            try:
+                network = ipaddress.ip_network(subnet, strict=False)
+            except ValueError:
+                print(f"跳过无效的ECS子网: {item}")
+                continue
+            regions.append((region or str(network), network))
+
+    return [
+        ResolverView(server, server_label, region, subnet)
+        for server_label, server in (servers or [('', None)])
+        for region, subnet in (regions or [('', None)])
+    ]
+
+
+def create_resolver(view: Optional[ResolverView] = None) -> dns.asyncresolver.Resolver:
+    resolver = dns.asyncresolver.Resolver()
+    resolver.timeout = DNS_QUERY_TIMEOUT
+    resolver.lifetime = DNS_QUERY_TIMEOUT
+    if view is not None and view.server is not None:
+        resolver.nameservers = [view.server[0]]
+        resolver.port = view.server[1]
+    if view is not None and view.subnet is not None:
+        # EDNS Client Subnet：让权威服务器按该子网所在地区返回边缘节点
+        option = dns.edns.ECSOption(str(view.subnet.network_address), view.subnet.prefixlen)
+        resolver.use_edns(0, 0, 1232, options=[option])
+    return resolver
+
+
+async def resolve_record(view: ResolverView, semaphore: asyncio.Semaphore,
+                         domain: str, rdtype: str) -> Optional[Tuple[List[str], int]]:
+    """查询一条记录，返回 (地址列表, TTL)；查询失败（非否定应答）时返回 None"""
+    async with semaphore:
+        try:
+            answer = await view.resolver.resolve(domain, rdtype, lifetime=DNS_QUERY_TIMEOUT)
+            return [rdata.address for rdata in answer], answer.rrset.ttl
+        except dns.resolver.NoAnswer:
+            return [], DNS_NEGATIVE_TTL
+        except dns.resolver.NXDOMAIN:
+            print(f"The domain {domain} does not exist.")
+            return [], DNS_NEGATIVE_TTL
+        except dns.exception.Timeout:
+            print(f"查询 {domain} {rdtype} 超时 ({view})")
+        except Exception as e:
+            print(f"An error occurred: {domain} {rdtype} ({view}): {e}")
+        return None
+
+
+async def resolve_domains(domains: List[str], cache: DNSCache,
+                          views: List[ResolverView]) -> Tuple[Dict[str, List[str]], Dict[str, List[str]]]:
+    """从所有解析视角并发解析域名的 A/AAAA 记录，未过期的缓存直接使用
+
+    返回 ({域名: 去重后的地址列表}, {地址: 地区标签列表})。
+    """
+    semaphore = asyncio.Semaphore(max(DNS_CONCURRENCY, 1))
+    queries = [(domain, rdtype, view) for domain in domains for rdtype in DNS_RECORD_TYPES for view in views]
+    pending = [(domain, rdtype, view) for domain, rdtype, view in queries
+               if cache.get(domain, rdtype, view.key) is None]
+    print(f"共 {len(queries)} 条查询（{len(views)} 个解析视角），{len(pending)} 条需要请求，其余使用缓存")
+
+    answers = await asyncio.gather(*(resolve_record(view, semaphore, d, t) for d, t, view in pending))
+    for (domain, rdtype, view), answer in zip(pending, answers):
+        if answer is not None:
+            cache.put(domain, rdtype, view.key, *answer)
+
+    results: Dict[str, List[str]] = {}
+    tags: Dict[str, List[str]] = {}
+    for domain in domains:
+        records = []
+        for rdtype in DNS_RECORD_TYPES:
+            for view in views:
+                for ip in cache.get(domain, rdtype, view.key, allow_expired=True) or []:
+                    records.append(ip)
+                    ip_tags = tags.setdefault(ip, [])
+                    if view.tag not in ip_tags:
+                        ip_tags.append(view.tag)
+        results[domain] = list(dict.fromkeys(records))
+    return results, tags
+
+
+def main():
     # 从指定的URL获取域名列表
-    url = "https://raw.githubusercontent.com/leung7963/CFIPS/refs/heads/main/domain.js"
-    response = requests.get(url)
+    response = requests.get(DOMAIN_LIST_URL)
     if response.status_code == 200:
-        domains = response.text.splitlines()
+        domains = list(dict.fromkeys(line.strip() for line in response.text.splitlines() if line.strip()))
     else:
         print(f"无法从指定URL获取域名列表，状态码: {response.status_code}")
         exit(1)
 
+    start_time = time.time()
+    views = build_views()
+    cache = DNSCache()
+    results, tags = asyncio.run(resolve_domains(domains, cache, views))
+    cache.save({DNSCache.key(domain, rdtype, view.key)
+                for domain in domains for rdtype in DNS_RECORD_TYPES for view in views})
+    print(f"解析 {len(domains)} 个域名耗时 {time.time() - start_time:.2f} 秒")
+
+    index = CIDRIndex.from_files()
+
     with open("domain_ips.js", "w") as output_file:
         for domain in domains:
-            domain = domain.strip()
-            a_records = get_a_records(domain)
+            # 只保留落在 Cloudflare 地址范围内的记录
+            buckets, rejected = index.bucket(results[domain])
+            records = CIDRIndex.interleave(buckets)
+            if rejected:
+                print(f"{domain}: 丢弃 {len(rejected)} 个不属于 Cloudflare 的地址")
 
-            if a_records:
+            if records:
                 output_file.write(f"Domain: {domain}\n")
-                for record in a_records:
+                for record in records:
                     output_file.write(record + "\n")
-                output_file.write("")
\ No newline at end of file
+
+    # 记录每个IP是从哪些地区（或解析器）的视角解析到的，供探测阶段优先选择
+    region_tags = {ip: ip_tags for ip, ip_tags in tags.items() if index.lookup(ip)}
+    with open(DOMAIN_REGIONS_FILE, "w", encoding="utf-8") as file:
+        json.dump(region_tags, file, ensure_ascii=False, indent=1)
+    counts: Dict[str, int] = {}
+    for ip_tags in region_tags.values():
+        for tag in ip_tags:
+            counts[tag] = counts.get(tag, 0) + 1
+    print("各地区候选IP数量: " + ", ".join(f"{tag}={count}" for tag, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
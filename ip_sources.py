@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import heapq
+import hashlib
+import tempfile
+from typing import List, Dict, Tuple, Optional, Iterable
+
+IP_SOURCES_FILE = os.environ.get("IP_SOURCES_FILE", "ip_sources.json")  # 来源登记表: [{"name", "url", "render", "enabled", "weight"}, ...]
+IP_SOURCES_STATE = os.environ.get("IP_SOURCES_STATE", "ip_sources_state.json")  # 各来源的抓取与探测统计
+IP_PROVENANCE_FILE = os.environ.get("IP_PROVENANCE_FILE", "ip_provenance.json")  # 每个IP的来源和抓取时间
+SOURCE_DEAD_RUNS = int(os.environ.get("SOURCE_DEAD_RUNS", "3"))  # 连续多少次抓取不到IP视为失效
+SOURCE_STALE_DAYS = float(os.environ.get("SOURCE_STALE_DAYS", "7"))  # 内容超过该天数没有变化视为陈旧
+SOURCE_RETRY_HOURS = float(os.environ.get("SOURCE_RETRY_HOURS", "24"))  # 被跳过的来源每隔多久重新尝试一次
+
+
+def write_json_atomic(path: str, data) -> None:
+    """先写临时文件再替换，避免中断时留下半个JSON文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_json(path: str, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return default
+
+
+class SourceRegistry:
+    """IP来源登记表
+
+    来源列表来自 IP_SOURCES_FILE，增删来源或调整权重无需改代码。每次抓取记录IP数量、内容摘要和时间，
+    连续多次取不到IP的来源视为失效，内容长期不变的视为陈旧，两者都会被跳过，只每隔 SOURCE_RETRY_HOURS
+    重试一次。cfip.py 探测后回写每个来源的合格率，用于按来源分配探测预算。
+    """
+
+    def __init__(self, path: str = IP_SOURCES_FILE, state_path: str = IP_SOURCES_STATE,
+                 provenance_path: str = IP_PROVENANCE_FILE):
+        self.path = path
+        self.state_path = state_path
+        self.provenance_path = provenance_path
+
+        self.sources: List[Dict] = []
+        for entry in read_json(path, []):
+            if not isinstance(entry, dict) or not entry.get('url'):
+                print(f"跳过无效的来源配置: {entry}")
+                continue
+            source = {'render': False, 'enabled': True, 'weight': 1.0}
+            source.update(entry)
+            source.setdefault('name', source['url'])
+            self.sources.append(source)
+        self.state: Dict[str, Dict] = read_json(state_path, {})
+
+    def _stats(self, name: str) -> Dict:
+        return self.state.setdefault(name, {'probed': 0, 'passed': 0, 'consecutive_empty': 0})
+
+    def source_status(self, name: str, now: Optional[float] = None) -> Optional[str]:
+        """返回 'dead'（连续抓取失败）、'stale'（内容长期未变）或 None"""
+        now = now or time.time()
+        stats = self.state.get(name)
+        if not stats:
+            return None
+        if stats.get('consecutive_empty', 0) >= SOURCE_DEAD_RUNS:
+            return 'dead'
+        changed_at = stats.get('changed_at')
+        if changed_at and now - changed_at > SOURCE_STALE_DAYS * 86400:
+            return 'stale'
+        return None
+
+    def active_sources(self) -> List[Dict]:
+        """本次需要抓取的来源：已启用，且不是失效/陈旧状态（或已到重试时间）"""
+        now = time.time()
+        active = []
+        for source in self.sources:
+            if not source['enabled']:
+                continue
+            status = self.source_status(source['name'], now)
+            last_fetch = self.state.get(source['name'], {}).get('last_fetch', 0)
+            if status and now - last_fetch < SOURCE_RETRY_HOURS * 3600:
+                print(f"跳过{'失效' if status == 'dead' else '陈旧'}的来源: {source['name']}")
+                continue
+            active.append(source)
+        return active
+
+    def record_fetch(self, name: str, ips: List[str], fetched_at: float) -> None:
+        """记录一次抓取结果"""
+        stats = self._stats(name)
+        stats['last_fetch'] = fetched_at
+        stats['last_count'] = len(ips)
+        if not ips:
+            stats['consecutive_empty'] = stats.get('consecutive_empty', 0) + 1
+            return
+        stats['consecutive_empty'] = 0
+        stats['last_success'] = fetched_at
+        digest = hashlib.sha1('\n'.join(sorted(set(ips))).encode('utf-8')).hexdigest()
+        if digest != stats.get('digest'):
+            stats['digest'] = digest
+            stats['changed_at'] = fetched_at
+
+    @staticmethod
+    def build_provenance(fetched: Iterable[Tuple[str, List[str], float]]) -> Dict[str, Dict]:
+        """按来源顺序合并去重，保留每个IP的全部来源和最早的抓取时间"""
+        provenance: Dict[str, Dict] = {}
+        for name, ips, fetched_at in fetched:
+            for ip in ips:
+                entry = provenance.get(ip)
+                if entry is None:
+                    provenance[ip] = {'sources': [name], 'fetched_at': round(fetched_at, 3)}
+                elif name not in entry['sources']:
+                    entry['sources'].append(name)
+        return provenance
+
+    def save_provenance(self, provenance: Dict[str, Dict]) -> None:
+        write_json_atomic(self.provenance_path, provenance)
+
+    def load_provenance(self) -> Dict[str, Dict]:
+        return read_json(self.provenance_path, {})
+
+    def record_probe_results(self, results: Iterable[Tuple[str, bool]], ip_sources: Dict[str, List[str]]) -> None:
+        """把探测结果计入对应来源的统计，ip_sources 为 {IP: [来源名, ...]}"""
+        for ip, success in results:
+            for name in ip_sources.get(ip, ()):
+                stats = self._stats(name)
+                stats['probed'] = stats.get('probed', 0) + 1
+                if success:
+                    stats['passed'] = stats.get('passed', 0) + 1
+
+    def source_weight(self, name: str) -> float:
+        """来源权重 = 配置权重 × 平滑后的历史合格率"""
+        configured = next((source['weight'] for source in self.sources if source['name'] == name), 1.0)
+        stats = self.state.get(name, {})
+        return float(configured) * (stats.get('passed', 0) + 1) / (stats.get('probed', 0) + 2)
+
+    def allocate(self, groups: Dict[str, List[str]], limit: int) -> List[str]:
+        """按来源权重分配探测预算，权重越高的来源越早、越多地被选中"""
+        heap = [(-self.source_weight(name), name) for name, members in groups.items() if members]
+        heapq.heapify(heap)
+        taken = {name: 0 for name in groups}
+        selected = []
+        while heap and len(selected) < limit:
+            _, name = heapq.heappop(heap)
+            selected.append(groups[name][taken[name]])
+            taken[name] += 1
+            if taken[name] < len(groups[name]):
+                # 与按得票分配议席相同：每选一个，该来源的优先级按 权重/(已选数+1) 下降
+                heapq.heappush(heap, (-self.source_weight(name) / (taken[name] + 1), name))
+        return selected
+
+    def save_state(self) -> None:
+        try:
+            write_json_atomic(self.state_path, self.state)
+        except OSError as e:
+            print(f"保存来源统计 {self.state_path} 失败: {e}")
+
+    def summary(self) -> List[str]:
+        lines = []
+        for name, stats in sorted(self.state.items()):
+            probed = stats.get('probed', 0)
+            rate = f"{stats.get('passed', 0) / probed:.0%}" if probed else "-"
+            lines.append(f"{name}: 最近抓取 {stats.get('last_count', 0)} 个IP，探测 {probed} 次，合格率 {rate}")
+        return lines
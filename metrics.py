@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import threading
+import tempfile
+import functools
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+METRICS_REPORT = os.environ.get("METRICS_REPORT", "run_report.json")  # 运行报告（JSON），留空则不输出
+METRICS_PROMETHEUS_FILE = os.environ.get("METRICS_PROMETHEUS_FILE", "")  # node_exporter textfile 路径，留空则不输出
+METRICS_PREFIX = "cfip"
+
+# 延迟直方图的桶上界（毫秒）
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """固定分桶的直方图，记录次数、总和、最值，百分位按桶上界估算"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶为 +Inf
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> Dict:
+        return {
+            'count': self.count,
+            'sum': round(self.total, 3),
+            'avg': round(self.total / self.count, 3) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets + ('+Inf',), self.counts)},
+        }
+
+
+class Metrics:
+    """轻量的运行指标：阶段耗时（span）、延迟直方图、按标签计数的计数器，线程安全"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.spans: Dict[str, Dict] = {}
+            self.histograms: Dict[str, Histogram] = {}
+            self.counters: Dict[str, Dict[str, int]] = {}
+            self.counter_labels: Dict[str, str] = {}
+            self.info: Dict[str, object] = {}
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """记录一个阶段的耗时；同名阶段多次执行时累计次数和总耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                entry = self.spans.setdefault(name, {'count': 0, 'seconds': 0.0})
+                entry['count'] += 1
+                entry['seconds'] += elapsed
+
+    def timed(self, name: str):
+        """装饰器形式的 span，记录函数每次调用的耗时"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, label: str = '', amount: int = 1, label_name: str = 'label'):
+        with self.lock:
+            self.counter_labels.setdefault(name, label_name)
+            series = self.counters.setdefault(name, {})
+            series[label] = series.get(label, 0) + amount
+
+    def set_info(self, key: str, value):
+        with self.lock:
+            self.info[key] = value
+
+    def report(self) -> Dict:
+        with self.lock:
+            return {
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+                'duration_seconds': round(time.time() - self.started_at, 3),
+                'info': dict(self.info),
+                'spans': {name: {'count': entry['count'], 'seconds': round(entry['seconds'], 4)}
+                          for name, entry in self.spans.items()},
+                'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+                'counters': {name: dict(series) for name, series in self.counters.items()},
+            }
+
+    def prometheus(self) -> str:
+        """生成 Prometheus 文本格式（供 node_exporter textfile collector 读取）"""
+        lines = []
+        with self.lock:
+            lines.append(f"# TYPE {METRICS_PREFIX}_stage_seconds gauge")
+            for name, entry in self.spans.items():
+                lines.append(f'{METRICS_PREFIX}_stage_seconds{{stage="{name}"}} {entry["seconds"]:.6f}')
+            for name, series in self.counters.items():
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name}_total counter")
+                for label, value in series.items():
+                    labels = f'{{{self.counter_labels.get(name, "label")}="{label}"}}' if label else ''
+                    lines.append(f"{METRICS_PREFIX}_{name}_total{labels} {value}")
+            for name, histogram in self.histograms.items():
+                metric = f"{METRICS_PREFIX}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum {histogram.total:.6f}")
+                lines.append(f"{metric}_count {histogram.count}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_last_run_timestamp_seconds gauge")
+            lines.append(f"{METRICS_PREFIX}_last_run_timestamp_seconds {time.time():.0f}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, report_path: str = METRICS_REPORT, prometheus_path: str = METRICS_PROMETHEUS_FILE):
+        """输出运行报告和 Prometheus textfile（均为原子写入）"""
+        outputs = []
+        if report_path:
+            outputs.append((report_path, json.dumps(self.report(), ensure_ascii=False, indent=1)))
+        if prometheus_path:
+            outputs.append((prometheus_path, self.prometheus()))
+        for path, content in outputs:
+            try:
+                fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(path)))
+                with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                    file.write(content)
+                os.replace(tmp_path, path)
+                print(f"运行指标已写入 {path}")
+            except OSError as e:
+                print(f"写入运行指标 {path} 失败: {e}")
+
+
+METRICS = Metrics()